@@ -7,66 +7,306 @@ import scipy.stats as st
 import scipy.cluster.vq as vq
 import math
 import random
+import weakref
+import collections
 import data as dt
 
+# number of normalized column blocks kept per Data object by normalizeColumnsSeparately
+NORMALIZED_MEMO_ENTRIES = 8
+
+# Data object -> [version, {header: (min, max)}, {headers: normalized matrix}] for the version of the Data object that
+# the entries were computed from; an entry is dropped with its Data object
+normalizedMemo = weakref.WeakKeyDictionary()
+
 # Takes in a list of column headers and the Data object and returns a list of 2-element lists with the minimum and
 # maximum values for each column
+# The Data object can also be an iterable of Data blocks (such as Data.iter_chunks), in which case the blocks are
+# summarized one at a time in bounded memory
 def dataRange(colHeaders, data):
 
-    ranges = []
-    for col in colHeaders:
-        ranges.append([np.min(data.get_column(col)), np.max(data.get_column(col))])
-    return np.array(ranges)
+    if isChunks(data):
+        count, means, m2, mins, maxes = chunkMoments(colHeaders, data)
+        return np.array([mins, maxes]).T
+
+    mins, maxes = columnRanges(colHeaders, data)
+    return np.array([mins, maxes]).T
+
+# Returns the memo entry of a Data object for its current version, starting a new one if the data has changed since
+def memoEntry(data):
+
+    entry = normalizedMemo.get(data)
+    if entry is None or entry[0] != data.get_version():
+        entry = [data.get_version(), {}, collections.OrderedDict()]
+        normalizedMemo[data] = entry
+    return entry
+
+# Takes in a list of column headers and the Data object and returns arrays of the minimum and maximum of each column,
+# skipping missing values
+# The minimum and maximum of each column are remembered until the data changes, and the columns that are not remembered
+# yet are scanned together in one pass (or taken from the running moments if they are tracked)
+def columnRanges(colHeaders, data):
+
+    ranges = memoEntry(data)[1]
+    needed = [header for header in dict.fromkeys(colHeaders) if header not in ranges]
+    if needed:
+        moments = data.get_moments(needed)
+        if moments is not None:
+            count, means, m2, mins, maxes = moments
+        else:
+            matrix = data.get_data(needed)
+            if hasMissing(matrix):
+                mins = np.asarray(np.nanmin(matrix, axis=0)).reshape(-1)
+                maxes = np.asarray(np.nanmax(matrix, axis=0)).reshape(-1)
+            else:
+                mins = np.asarray(np.min(matrix, axis=0)).reshape(-1)
+                maxes = np.asarray(np.max(matrix, axis=0)).reshape(-1)
+        for j in range(len(needed)):
+            ranges[needed[j]] = (mins[j], maxes[j])
+    return (np.array([ranges[header][0] for header in colHeaders]),
+            np.array([ranges[header][1] for header in colHeaders]))
 
 # Takes in a list of column headers and the Data object and returns a list of the mean values for each column
 def mean(colHeaders, data):
 
-    return np.mean(data.get_data(colHeaders), axis=0)
+    if isChunks(data):
+        count, means, m2, mins, maxes = chunkMoments(colHeaders, data)
+        return np.matrix(means)
+
+    moments = data.get_moments(colHeaders)
+    if moments is not None:
+        count, means, m2, mins, maxes = moments
+        return np.matrix(means)
+
+    matrix = data.get_data(colHeaders)
+    if hasMissing(matrix):
+        return np.matrix(np.nanmean(matrix, axis=0))
+    return np.mean(matrix, axis=0)
 
 # Takes in a list of column headers and the Data object and returns a list of the standard deviation for each column
 def stdev(colHeaders, data):
 
-    return np.std(data.get_data(colHeaders), axis=0)
+    if isChunks(data):
+        count, means, m2, mins, maxes = chunkMoments(colHeaders, data)
+        return np.matrix(np.sqrt(m2 / count))
+
+    moments = data.get_moments(colHeaders)
+    if moments is not None:
+        count, means, m2, mins, maxes = moments
+        return np.matrix(np.sqrt(m2 / count))
+
+    matrix = data.get_data(colHeaders)
+    if hasMissing(matrix):
+        return np.matrix(np.nanstd(matrix, axis=0))
+    return np.std(matrix, axis=0)
+
+# Returns whether data is an iterable of Data blocks rather than a single Data object
+def isChunks(data):
+
+    return not hasattr(data, 'get_data')
+
+# Returns whether a matrix has any missing (NaN) values; the sum is NaN if any value is, so this takes a single pass
+# without building a mask
+def hasMissing(matrix):
+
+    return np.issubdtype(matrix.dtype, np.floating) and bool(np.isnan(np.sum(matrix)))
+
+# Returns a copy of a matrix with the missing (NaN) values of each column replaced by the mean of the column
+def fillMissing(matrix):
+
+    filled = np.array(matrix, dtype='float64')
+    missing = np.isnan(filled)
+    # columns with no values at all are filled with zeros
+    means = np.nansum(filled, axis=0) / np.maximum(np.count_nonzero(~missing, axis=0), 1)
+    rows, cols = np.nonzero(missing)
+    filled[rows, cols] = means[cols]
+    return np.asmatrix(filled)
+
+# Takes in a list of column headers and an iterable of Data blocks and returns the number of values (missing values are
+# not counted) and the mean, sum of squared deviations, minimum, and maximum of each column, merging the per-block
+# statistics so only one block has to be in memory at a time
+def chunkMoments(colHeaders, chunks):
+
+    count = np.zeros(len(colHeaders))
+    means = np.zeros(len(colHeaders))
+    m2 = np.zeros(len(colHeaders))
+    mins = np.full(len(colHeaders), np.inf)
+    maxes = np.full(len(colHeaders), -np.inf)
+    for chunk in chunks:
+        A = np.asarray(chunk.get_data(colHeaders), dtype='float64')
+        if A.shape[0] == 0:
+            continue
+        if hasMissing(A):
+            valid = ~np.isnan(A)
+            n = np.count_nonzero(valid, axis=0)
+            chunkMeans = np.where(valid, A, 0).sum(axis=0) / np.maximum(n, 1)
+            chunkM2 = np.sum(np.square(np.where(valid, A - chunkMeans, 0)), axis=0)
+            mins = np.minimum(mins, np.where(valid, A, np.inf).min(axis=0))
+            maxes = np.maximum(maxes, np.where(valid, A, -np.inf).max(axis=0))
+        else:
+            n = np.full(A.shape[1], A.shape[0])
+            chunkMeans = np.mean(A, axis=0)
+            chunkM2 = np.sum(np.square(A - chunkMeans), axis=0)
+            mins = np.minimum(mins, np.min(A, axis=0))
+            maxes = np.maximum(maxes, np.max(A, axis=0))
+        # combine the two sets of moments (Chan et al. parallel variance)
+        total = count + n
+        weight = n / np.maximum(total, 1)
+        delta = chunkMeans - means
+        means = means + delta * weight
+        m2 = m2 + chunkM2 + np.square(delta) * count * weight
+        count = total
+
+    if not np.any(count):
+        print("Error: no rows in the given data blocks.")
+    empty = count == 0
+    means[empty] = m2[empty] = mins[empty] = maxes[empty] = np.nan
+    return count, means, m2, mins, maxes
 
 # Takes in a list of column headers and the Data object and returns a matrix with each column normalized so its minimum
 # value is mapped to zero and its maximum value is mapped to 1
+# The result is remembered until the data changes, so asking for the same columns again (such as when the display
+# replots) returns it without another pass; it is returned read-only
 def normalizeColumnsSeparately(colHeaders, data):
 
-    matrix = data.get_data(colHeaders)
-    mins = dataRange(colHeaders, data)[:, 0]
-    maxes = dataRange(colHeaders, data)[:, 1]
-    normalized = np.matrix(((matrix - mins) / (maxes - mins)))
+    blocks = memoEntry(data)[2]
+    key = tuple(colHeaders)
+    if key in blocks:
+        blocks.move_to_end(key)
+        return blocks[key]
+    normalized = scaleColumns(colHeaders, data)
+    normalized.flags.writeable = False
+    blocks[key] = normalized
+    while len(blocks) > NORMALIZED_MEMO_ENTRIES:
+        blocks.popitem(last=False)
+    return normalized
+
+# Takes in a list of column headers and the Data object and returns a new matrix with each column normalized so its
+# minimum value is mapped to zero and its maximum value is mapped to 1; missing values stay NaN
+def scaleColumns(colHeaders, data):
+
+    mins, maxes = columnRanges(colHeaders, data)
+    # make one new float matrix (int columns are stored as integers) and scale it in place
+    normalized = np.asmatrix(np.array(data.get_data(colHeaders), dtype='float64'))
+    normalized -= mins
+    normalized /= (maxes - mins)
     return normalized
 
 # Takes in a list of column headers and the Data object and returns a matrix with each entry normalized so that the
 # minimum value (of all the data in this set of columns) is mapped to zero and its maximum value is mapped to 1
 def normalizeColumnsTogether(colHeaders, data):
 
-    matrix = data.get_data(colHeaders)
-    min = np.min(data.matrix_data)
-    max = np.max(data.matrix_data)
-    normalized = np.matrix(((matrix - min) / (max - min)))
+    mins, maxes = columnRanges(colHeaders, data)
+    min = np.nanmin(mins)
+    max = np.nanmax(maxes)
+    normalized = np.matrix(((data.get_data(colHeaders) - min) / (max - min)))
     return normalized
 
 # Takes in a list of column headers and the Data object and returns a list of the variance for each column
 def variance(colHeaders, data):
 
-    return np.var(data.get_data(colHeaders), axis=0)
+    if isChunks(data):
+        count, means, m2, mins, maxes = chunkMoments(colHeaders, data)
+        return np.matrix(m2 / count)
 
-# Takes in a list of column headers and the Data object and returns a list of the mean values for each column
+    moments = data.get_moments(colHeaders)
+    if moments is not None:
+        count, means, m2, mins, maxes = moments
+        return np.matrix(m2 / count)
+
+    matrix = data.get_data(colHeaders)
+    if hasMissing(matrix):
+        return np.matrix(np.nanvar(matrix, axis=0))
+    return np.var(matrix, axis=0)
+
+# Takes in a list of column headers and the Data object and returns a list of the median values for each column
+# The Data object can also be an iterable of Data blocks, in which case the medians are estimated with quantile sketches
 def median(colHeaders, data):
 
-    return np.median(data.get_data(colHeaders), axis=0)
+    if isChunks(data):
+        return quantiles(colHeaders, data, [0.5], error=dt.SKETCH_ERROR)
+
+    matrix = data.get_data(colHeaders)
+    if hasMissing(matrix):
+        return np.matrix(np.nanmedian(np.asarray(matrix), axis=0))
+    return np.median(matrix, axis=0)
+
+# Takes in a list of column headers, the Data object, and a list of quantiles (each between 0 and 1) and returns a matrix
+# with a row for each quantile and a column for each header, skipping missing values
+# With an error (a fraction of the number of values, such as 0.01), the quantiles are estimated with one QuantileSketch
+# per column, so the ranks of the results are within about that fraction of the exact ones; the Data object can then
+# also be an iterable of Data blocks, which are summarized one at a time in bounded memory. Without one they are exact
+def quantiles(colHeaders, data, qs, error=None):
+
+    qs = np.asarray(qs, dtype='float64').reshape(-1)
+    if error is None:
+        if isChunks(data):
+            print("Error: exact quantiles need a Data object; give an error to estimate them from data blocks.")
+            return None
+        matrix = np.asarray(data.get_data(colHeaders), dtype='float64')
+        if hasMissing(matrix):
+            return np.matrix(np.nanquantile(matrix, qs, axis=0))
+        return np.matrix(np.quantile(matrix, qs, axis=0))
+
+    sketches = [dt.QuantileSketch(error) for header in colHeaders]
+    for chunk in (data if isChunks(data) else [data]):
+        A = np.asarray(chunk.get_data(colHeaders), dtype='float64')
+        for j in range(len(colHeaders)):
+            sketches[j].add(A[:, j])
+    return np.matrix(np.column_stack([sketch.quantiles(qs) for sketch in sketches]))
 
 # Takes in a list of column headers and the Data object and returns a list of the most common values for each column
 def modeValue(colHeaders, data):
 
-    return st.mode(data.get_data(colHeaders), axis=0)[0]
+    return modes(colHeaders, data)[0]
 
 # Takes in a list of column headers and the Data object and returns a list of the highest frequencies for each column
 def modeFreq(colHeaders, data):
 
-    return st.mode(data.get_data(colHeaders), axis=0)[1]
+    return modes(colHeaders, data)[1]
+
+# Takes in a list of column headers and the Data object and returns two k x F matrices with the k most common values of
+# each column (most common first, smaller values first on ties) and their frequencies, skipping missing values; a
+# column with fewer than k distinct values is padded with NaN values and zero frequencies
+# The headers can also be string or enum columns, whose values are then given as codes (see Data.get_categories)
+def modes(colHeaders, data, k=1):
+
+    values = np.full((k, len(colHeaders)), np.nan)
+    freqs = np.zeros((k, len(colHeaders)), dtype='int64')
+    categorical = data.get_categorical_headers()
+    for j in range(len(colHeaders)):
+        if colHeaders[j] in categorical:
+            column = np.asarray(data.get_codes(colHeaders[j])).reshape(-1)
+        else:
+            column = np.asarray(data.get_data([colHeaders[j]])).reshape(-1)
+        if np.issubdtype(column.dtype, np.floating):
+            column = column[~np.isnan(column)]
+        top, counts = countValues(column, k)
+        values[:len(top), j] = top
+        freqs[:len(counts), j] = counts
+    return np.matrix(values), np.matrix(freqs)
+
+# Takes in a 1-D array of values without missing values and returns arrays of its k most common values (most common
+# first, smaller values first on ties) and their frequencies
+# Integers in a range not much wider than the number of values (such as codes) are counted with one bincount; other
+# values are sorted (unless isSorted says they already are) so that equal values form runs whose lengths are the counts
+def countValues(values, k=1, isSorted=False):
+
+    if len(values) == 0:
+        return values[:0], np.zeros(0, dtype='int64')
+    if np.issubdtype(values.dtype, np.integer):
+        low = int(np.min(values))
+        span = int(np.max(values)) - low
+        if span < 2 * len(values) + 256:
+            counts = np.bincount(values.astype('int64') - low, minlength=span + 1)
+            distinct = np.flatnonzero(counts)
+            top = distinct[np.argsort(-counts[distinct], kind='stable')[:k]]
+            return top + low, counts[top]
+    if not isSorted:
+        values = np.sort(values)
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    lengths = np.diff(np.append(starts, len(values)))
+    top = np.argsort(-lengths, kind='stable')[:k]
+    return values[starts[top]], lengths[top]
 
 # Takes in a list of column headers and the Data object and returns a list of the range (max - min) for each column
 def rangeDiff(colHeaders, data):
@@ -77,12 +317,55 @@ def rangeDiff(colHeaders, data):
         result.append(hilo[i][1] - hilo[i][0])
     return result
 
+# Takes in a list of column headers and the Data object and returns a dictionary of descriptive statistics, each a
+# 1 x F matrix with one value per column: count (values that are not missing), mean, stdev, variance, median, mode,
+# modeFreq, min, max, and range. The columns are gathered once and each is sorted once: the sorted values give the
+# minimum, maximum, median, and mode, and the moments come from the same block, so missing values are skipped
+# throughout. An iterable of Data blocks gives every statistic except the median and mode
+def describe(colHeaders, data):
+
+    if isChunks(data):
+        count, means, m2, mins, maxes = chunkMoments(colHeaders, data)
+        variances = m2 / np.maximum(count, 1)
+        return {'count': np.matrix(count), 'mean': np.matrix(means), 'stdev': np.matrix(np.sqrt(variances)),
+                'variance': np.matrix(variances), 'min': np.matrix(mins), 'max': np.matrix(maxes),
+                'range': np.matrix(maxes - mins)}
+
+    A = np.sort(np.asarray(data.get_data(colHeaders), dtype='float64'), axis=0)  # missing values sort to the end
+    F = A.shape[1]
+    count = np.count_nonzero(~np.isnan(A), axis=0)
+    mins = np.full(F, np.nan)
+    maxes = np.full(F, np.nan)
+    means = np.full(F, np.nan)
+    variances = np.full(F, np.nan)
+    medians = np.full(F, np.nan)
+    modeValues = np.full(F, np.nan)
+    modeFreqs = np.zeros(F, dtype='int64')
+    for j in range(F):
+        n = count[j]
+        if n == 0:
+            continue
+        values = A[:n, j]
+        mins[j] = values[0]
+        maxes[j] = values[-1]
+        medians[j] = (values[(n - 1) // 2] + values[n // 2]) / 2
+        means[j] = np.mean(values)
+        variances[j] = np.mean(np.square(values - means[j]))
+        top, counts = countValues(values, 1, isSorted=True)
+        modeValues[j] = top[0]
+        modeFreqs[j] = counts[0]
+
+    return {'count': np.matrix(count), 'mean': np.matrix(means), 'stdev': np.matrix(np.sqrt(variances)),
+            'variance': np.matrix(variances), 'median': np.matrix(medians), 'mode': np.matrix(modeValues),
+            'modeFreq': np.matrix(modeFreqs), 'min': np.matrix(mins), 'max': np.matrix(maxes),
+            'range': np.matrix(maxes - mins)}
+
 # Runs linear regression for one or more independent variables
 # Parameters: a list of headers for the independent variables, a single header for the dependent variable, and data
 def linear_regression(d, ind, dep):
 
     y = d.get_column(dep)
-    A = d.get_data(ind)
+    A = d.get_data(ind, dtype='float64')
     A = np.hstack((A, np.ones((A.shape[0], 1))))
 
     # The matrix A.T * A is the covariance matrix of the independent
@@ -132,7 +415,7 @@ def linear_regression(d, ind, dep):
 def linear_regression_ne(d, ind, dep):
 
     y = d.get_column(dep)
-    A = d.get_data(ind)
+    A = d.get_data(ind, dtype='float64')
     A = np.hstack((A, np.ones((A.shape[0], 1))))
 
     # The matrix A.T * A is the covariance matrix of the independent
@@ -188,7 +471,7 @@ def linear_regression_gd(d, ind, dep):
     # the dependent variable data
     y = d.get_column(dep)
     # the independent variable data
-    A = d.get_data(ind)
+    A = d.get_data(ind, dtype='float64')
     A = np.hstack((A, np.ones((A.shape[0], 1))))
     # The matrix A.T * A is the covariance matrix of the independent
     # data, and we will use it for computing the standard error of the
@@ -297,7 +580,7 @@ def linear_regression_nn(d, ind, dep):
     # the dependent variable data
     y = d.get_column(dep)
     # the independent variable data
-    A = d.get_data(ind)
+    A = d.get_data(ind, dtype='float64')
     A = np.hstack((A, np.ones((A.shape[0], 1))))
     # The matrix A.T * A is the covariance matrix of the independent
     # data, and we will use it for computing the standard error of the
@@ -416,14 +699,23 @@ def testRegression(data):
     # testRegression called in data.py
 
 # Calculates Principal Components Analysis on the passed-in Data object using Singular Value Decomposition
+# Missing values are replaced by the mean of their column, so they contribute nothing after centering
 def pca(data, headers, norm=True):
 
     if norm:
-        A = normalizeColumnsSeparately(headers, data)
+        A = scaleColumns(headers, data)
+    else:
+        A = data.get_data(headers, dtype='float64')
+    missing = hasMissing(A)
+    m = np.matrix(np.nanmean(A, axis=0)) if missing else np.mean(A, axis=0)
+    if norm:
+        # A is already a new matrix, so center it in place instead of making another copy
+        D = A
+        D -= m
     else:
-        A = data.get_data(headers)
-    m = np.mean(A, axis=0)
-    D = A - m
+        D = A - m
+    if missing:
+        D[np.isnan(D)] = 0
     U, S, V = np.linalg.svd(D, full_matrices=False)
     evals = np.matrix(np.square(S) / (A.shape[0]-1))
     evecs = V
@@ -438,7 +730,9 @@ def kmeans_numpy(data, headers, K, whiten=True):
     Computes and returns the codebook, codes, and representation error.
     '''
 
-    A = data.get_data(headers)
+    A = data.get_data(headers, dtype='float64')
+    if hasMissing(A):
+        A = fillMissing(A)
     W = vq.whiten(A)
     codebook, bookerror = vq.kmeans2(W, K)
     codes, error = vq.vq(W, codebook)
@@ -447,22 +741,17 @@ def kmeans_numpy(data, headers, K, whiten=True):
 
 def kmeans_init(dataMatrix, K, categories=''):
 
-    if categories == '':
+    if type(categories) == str:
         # Return K random data points from data
         return dataMatrix[random.sample(range(dataMatrix.shape[0]), K), :]
     else:
-        # Given an Nx1 matrix of labels, compute the mean values of each category and return those as the initial set of means
-        means = np.zeros((K, dataMatrix.shape[1]))
-        for i in range(K):
-            # Grab the data that matches the ith category
-            indicesOfInterest = np.array(categories[:, 0] == i)
-            rowsOfInterest = np.array(categories[:, 0] == i)
-            for j in range(dataMatrix.shape[1]-1):
-                rowsOfInterest = np.hstack((rowsOfInterest, indicesOfInterest))
-            dataOfInterest = dataMatrix[rowsOfInterest == True]
-            # Compute feature-wise means and add to the matrix of K means
-            means[i, :] = np.mean(dataOfInterest, axis=0)
-        return means
+        # Given an Nx1 matrix of labels, compute the mean values of each category in one pass over the data and return
+        # those as the initial set of means (categories 0 to K-1 that have no points get NaN means)
+        groups = dt.GroupBy(np.asarray(categories)[:, 0], dataMatrix)
+        means = np.full((K, dataMatrix.shape[1]), np.nan)
+        present = (groups.keys >= 0) & (groups.keys < K)
+        means[groups.keys[present].astype(int), :] = groups.agg('mean')['mean'][present]
+        return np.matrix(means)
 
 def kmeans_classify(dataMatrix, means):
 
@@ -485,6 +774,9 @@ def kmeans_classify(dataMatrix, means):
 
 def kmeans_algorithm(A, means):
 
+    # the means are averaged in place, so work in floating point even if the data is stored as integers
+    A = A.astype('float64', copy=False)
+    means = means.astype('float64', copy=False)
     # set up some useful constants
     MIN_CHANGE = 1e-7
     MAX_ITERATIONS = 100
@@ -501,8 +793,8 @@ def kmeans_algorithm(A, means):
         newmeans = np.zeros_like(means)
         counts = np.zeros((K, 1))
         for j in range(N):
-            newmeans[codes[j, 0], :] += A[j,:]
-            counts[codes[j, 0], 0] += 1.0
+            newmeans[int(codes[j, 0]), :] += A[j,:]
+            counts[int(codes[j, 0]), 0] += 1.0
 
         # finish calculating the means, taking into account possible zero counts
         for j in range(K):
@@ -528,9 +820,12 @@ def kmeans(data, headers, K, whiten=True, categories=''):
     Computes and returns the codebook, codes and representation errors.
     If given an Nx1 matrix of categories, it uses the category labels
     to calculate the initial cluster means.
+    Missing values are replaced by the mean of their column.
     '''
 
-    A = data.get_data(headers)
+    A = data.get_data(headers, dtype='float64')
+    if hasMissing(A):
+        A = fillMissing(A)
     if whiten:
         W = vq.whiten(A)
     else:
@@ -99,12 +99,11 @@ class NaiveBayes(Classifier):
         self.class_means = np.zeros((self.num_classes, self.num_features))
         self.class_vars = np.zeros((self.num_classes, self.num_features))
         self.class_scales = np.zeros((self.num_classes, self.num_features))
-        # compute the means/vars/scales for each class
-        for i in range(self.num_classes):
-            data = A[(mapping == i), :]
-            self.class_means[i, :] = np.mean(data, axis=0)
-            self.class_vars[i, :] = np.var(data, axis=0)
-            self.class_scales[i, :] = 1/np.sqrt(2*np.pi*np.var(data, axis=0))
+        # compute the means/vars/scales for all classes in one pass over A
+        stats = data.GroupBy(mapping, A).agg('mean', 'var')
+        self.class_means[:, :] = stats['mean']
+        self.class_vars[:, :] = stats['var']
+        self.class_scales[:, :] = 1/np.sqrt(2*np.pi*self.class_vars)
         # store any other necessary information: # of classes, # of features, original labels
 
         return
@@ -201,13 +200,14 @@ class KNN(Classifier):
         self.class_labels = np.matrix(mapping).T
         # for each category i, build the set of exemplars
         self.exemplars = []
+        groups = data.GroupBy(mapping, A)
         for i in range(self.num_classes):
-            data = A[(mapping == i), :]
+            classData = groups.group(i)
             if K is None:
-                self.exemplars.append(data)
+                self.exemplars.append(classData)
             else:
                 # run K-means on the rows of A where the category/mapping is i
-                codebook, bookerror = vq.kmeans2(data, K)
+                codebook, bookerror = vq.kmeans2(classData, K)
                 print(codebook)  # FIXME: numpy.linalg.linalg.LinAlgError: Matrix is not positive definite
                 self.exemplars.append(codebook)
         # store any other necessary information: # of classes, # of features, original labels
@@ -5,82 +5,877 @@
 """
 getters, setters, adders, deleters in both raw and numeric format?
 update method to equivocate raw data and numeric data? Call in read method?
-how to deal with NaNs?
 """
 
 import sys
-import copy
+import os
+import time
+import json
+import io
+import gzip
+import struct
+import hashlib
+import itertools
+import array
+import ast
 import operator
+import collections
+import weakref
 import numpy as np
 import csv
+import datetime
 import analysis
 
+# raw types that are stored in the numeric matrix
+NUMERIC_TYPES = ('numeric', 'int', 'float')
+
+# raw types that are also stored as integer codes into a table of their distinct values
+CATEGORICAL_TYPES = ('string', 'enum')
+
+# raw type of the columns that are parsed into datetime64 values (with a resolution of seconds)
+DATE_TYPE = 'date'
+DATE_UNIT = 'datetime64[s]'
+
+# formats tried for dates that are not ISO 8601 (such as 2010-06-29 or 2010-06-29 09:30:00), in order
+DATE_FORMATS = ('%m/%d/%y', '%m/%d/%Y', '%m/%d/%y %H:%M', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S', '%Y/%m/%d',
+                '%Y%m%d', '%d-%b-%y', '%d-%b-%Y', '%b %d %Y', '%B %d %Y', '%b %d, %Y', '%B %d, %Y')
+
+# binary files written next to a CSV file so that reopening it can skip parsing
+CACHE_SUFFIX = '.datacache'
+CACHE_FORMAT = 3  # changed whenever the contents of the cache change, so that older caches are parsed again
+BINARY_MAGIC = b'DATABIN1'
+BINARY_ALIGN = 64
+
+# limits on the number of get_data results kept per Data object and on their total size
+DATA_CACHE_ENTRIES = 8
+DATA_CACHE_BYTES = 1 << 28
+
+# marks a missing cell of an int column while a file is converted; such columns are then stored as floats with NaN
+INT_MISSING = np.iinfo('int64').min
+
+# number of rows converted to numbers at a time while reading a file, and formatted at a time while writing one
+READ_BLOCK_ROWS = 65536
+WRITE_BLOCK_ROWS = 65536
+
+# bytes that read_record looks for to find where a CSV record ends
+QUOTE_BYTE = ord('"')
+COMMA_BYTE = ord(',')
+SPACE_BYTE = ord(' ')
+
+# rank error (as a fraction of the number of values) of QuantileSketch when no size is given
+SKETCH_ERROR = 0.01
+
+# statistics that GroupBy.agg can compute
+GROUP_STATS = ('count', 'sum', 'mean', 'var', 'std', 'min', 'max')
+
+# operators allowed in the expressions given to Data.where
+QUERY_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.Mod: operator.mod, ast.Pow: operator.pow, ast.USub: operator.neg, ast.UAdd: operator.pos,
+    ast.Not: np.logical_not, ast.Invert: np.logical_not,
+    ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Eq: operator.eq,
+    ast.NotEq: operator.ne, ast.BitAnd: np.logical_and, ast.BitOr: np.logical_or
+}
+
+# returns the smallest signed integer type that can hold all of the values in an integer array
+def smallest_int_type(values):
+
+    if values.size == 0:
+        return np.dtype('int8')
+    low = values.min()
+    high = values.max()
+    for name in ('int8', 'int16', 'int32'):
+        info = np.iinfo(name)
+        if info.min <= low and high <= info.max:
+            return np.dtype(name)
+    return np.dtype('int64')
+
+# writes a dictionary of metadata and a dictionary of numpy arrays to a single binary file; each array is stored
+# uncompressed at an aligned offset so that it can be memory-mapped when the file is read back in
+def write_binary(path, meta, arrays):
+
+    meta = dict(meta)
+    meta['arrays'] = []
+    offset = 0
+    for name in arrays:
+        array = np.ascontiguousarray(arrays[name])
+        arrays[name] = array
+        meta['arrays'].append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset += -(-array.nbytes // BINARY_ALIGN) * BINARY_ALIGN
+    header = json.dumps(meta).encode('utf-8')
+    start = -(-(len(BINARY_MAGIC) + 8 + len(header)) // BINARY_ALIGN) * BINARY_ALIGN
+
+    # write to a temporary file first so a half-written file is never picked up
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(BINARY_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (start - len(BINARY_MAGIC) - 8 - len(header)))
+        for entry in meta['arrays']:
+            array = arrays[entry['name']]
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % BINARY_ALIGN))
+    os.replace(temp, path)
+
+# reads a file written by write_binary and returns the metadata and a dictionary of arrays; the arrays are
+# memory-mapped copy-on-write if mmap is True, so changing them never touches the file
+def read_binary(path, mmap=True):
+
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("%s is not a binary data file" % path)
+        length = struct.unpack('<Q', f.read(8))[0]
+        meta = json.loads(f.read(length).decode('utf-8'))
+        start = -(-(len(BINARY_MAGIC) + 8 + length) // BINARY_ALIGN) * BINARY_ALIGN
+
+        arrays = {}
+        for entry in meta['arrays']:
+            dtype = np.dtype(entry['dtype'])
+            shape = tuple(entry['shape'])
+            count = int(np.prod(shape))
+            if count == 0:
+                arrays[entry['name']] = np.empty(shape, dtype=dtype)
+            elif mmap:
+                arrays[entry['name']] = np.memmap(path, dtype=dtype, mode='c', offset=start + entry['offset'], shape=shape)
+            else:
+                f.seek(start + entry['offset'])
+                arrays[entry['name']] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+    return meta, arrays
+
+# returns the size, modification time, and md5 hash of a file, which together identify an unchanged file
+def file_signature(filename, stat=None):
+
+    if stat is None:
+        stat = os.stat(filename)
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'md5': md5.hexdigest()}
+
+# A list-like sequence of raw rows that only builds the list of strings for a row when the row is accessed. Each row is
+# identified by an integer key (its byte offset in the source file) that fetch turns into a list of strings; rows with
+# a negative key have no source and are made by build from their position instead. Rows that are accessed by index are
+# kept so that changes made to them stick; iterating does not keep them.
+class LazyRows:
+
+    # Constructor
+    def __init__(self, keys, fetch, build=None):
+
+        self.keys = array.array('q')
+        self.keys.frombytes(np.asarray(keys, dtype='int64').tobytes())
+        self.fetch = fetch
+        self.build = build
+        self.rows = {}  # row index -> list of strings for rows that have been built
+        # column changes made since the keys were recorded, in order: ('drop', raw column index) or ('add', an array
+        # with the string of each row)
+        self.edits = []
+
+    def __len__(self):
+
+        return len(self.keys)
+
+    # returns the list of strings for row i, building it from its key if necessary
+    def row(self, i, keep=True):
+
+        if i in self.rows:
+            return self.rows[i]
+        if self.keys[i] < 0:
+            row = self.build(i)
+        else:
+            row = self.fetch(self.keys[i])
+            for edit, arg in self.edits:
+                if edit == 'drop':
+                    del row[arg]
+                else:
+                    row.append(str(arg[i]))
+        if keep:
+            self.rows[i] = row
+        return row
+
+    # turns a possibly negative index into a position in the sequence
+    def position(self, i):
+
+        if i < 0:
+            i += len(self.keys)
+        if i < 0 or i >= len(self.keys):
+            raise IndexError("row index out of range")
+        return i
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return [self.row(j) for j in range(*i.indices(len(self.keys)))]
+        return self.row(self.position(i))
+
+    def __setitem__(self, i, row):
+
+        self.rows[self.position(i)] = list(row)
+
+    def __delitem__(self, i):
+
+        i = self.position(i)
+        del self.keys[i]
+        self.rows = {(j if j < i else j - 1): row for j, row in self.rows.items() if j != i}
+        self.edits = [(edit, arg if edit == 'drop' or i >= len(arg) else np.delete(arg, i)) for edit, arg in self.edits]
+
+    def __iter__(self):
+
+        for i in range(len(self.keys)):
+            yield self.row(i, keep=False)
+
+    def __repr__(self):
+
+        return "LazyRows(%i rows, %i built)" % (len(self.keys), len(self.rows))
+
+    def append(self, row):
+
+        self.keys.append(-1)
+        self.rows[len(self.keys) - 1] = list(row)
+
+    # keeps only the rows where mask is True
+    def keep(self, mask):
+
+        mask = np.asarray(mask, dtype=bool)
+        newRow = np.cumsum(mask) - 1
+        keys = np.frombuffer(self.keys, dtype='int64')[mask]
+        self.keys = array.array('q')
+        self.keys.frombytes(keys.tobytes())
+        self.rows = {int(newRow[i]): row for i, row in self.rows.items() if mask[i]}
+        self.edits = [(edit, arg if edit == 'drop' else arg[mask[:len(arg)]]) for edit, arg in self.edits]
+
+    # returns a LazyRows of the rows at the given positions that reads from the same source, without building them;
+    # rows that have been built are copied, and rows without a source are made by build
+    def take(self, positions, build):
+
+        positions = np.asarray(positions, dtype='int64')
+        rows = LazyRows(np.frombuffer(self.keys, dtype='int64')[positions], self.fetch, build)
+        rows.edits = [(edit, arg if edit == 'drop' or len(arg) == 0 else arg.take(positions, mode='clip'))
+                      for edit, arg in self.edits]
+        built = np.fromiter(self.rows, dtype='int64', count=len(self.rows))
+        for i in np.flatnonzero(np.isin(positions, built)):
+            rows.rows[int(i)] = list(self.rows[int(positions[i])])
+        return rows
+
+    # adds count rows that will be made by build when they are accessed
+    def extend_unbuilt(self, count):
+
+        self.keys.extend(itertools.repeat(-1, count))
+
+    # removes a column from every row without building the rows that have not been accessed yet
+    def delete_column(self, col):
+
+        for row in self.rows.values():
+            del row[col]
+        self.edits.append(('drop', col))
+
+    # adds a column to the end of every row, given as the string of each row, without building the rows that have not
+    # been accessed yet
+    def add_column(self, values):
+
+        values = np.asarray(values, dtype=str)
+        for i, row in self.rows.items():
+            row.append(str(values[i]))
+        self.edits.append(('add', values))
+
+
+# returns the int64 codes of a sequence of strings in a table of distinct strings (a list, where a code is the index of
+# its string); strings that are not in the table yet are added to its end
+def encode_categories(values, table):
+
+    unique, inverse = np.unique(np.array(values, dtype=str), return_inverse=True)
+    index = {}
+    for code in range(len(table)):
+        index[table[code]] = code
+    mapping = np.empty(len(unique), dtype='int64')
+    for i in range(len(unique)):
+        value = str(unique[i])
+        if value not in index:
+            index[value] = len(table)
+            table.append(value)
+        mapping[i] = index[value]
+    return mapping[inverse.reshape(-1)]
+
+
+# converts a sequence of strings to a DATE_UNIT array; ISO 8601 dates are converted by numpy in one call, and other
+# dates are parsed once per distinct string with the first of DATE_FORMATS that fits; blank or unreadable dates are NaT
+def parse_dates(values):
+
+    # numpy reads a string of digits such as 20100629 as a year, so only strings with a '-' after the year (or blank
+    # ones) are given to it; the others go through DATE_FORMATS
+    values = np.array(values, dtype=str)
+    iso = (np.char.find(values, '-') > 0) | (np.char.strip(values) == '')
+    if np.all(iso):
+        try:
+            return np.array(values, dtype=DATE_UNIT)
+        except ValueError:
+            pass
+    unique, inverse = np.unique(values, return_inverse=True)
+    parsed = np.full(len(unique), np.datetime64('NaT'), dtype=DATE_UNIT)
+    formats = list(DATE_FORMATS)
+    for i in range(len(unique)):
+        value = str(unique[i]).strip()
+        if value.find('-') > 0 or value == '':
+            try:
+                parsed[i] = np.datetime64(value, 's')
+                continue
+            except ValueError:
+                pass
+        for j in range(len(formats)):
+            try:
+                parsed[i] = np.datetime64(datetime.datetime.strptime(value, formats[j]), 's')
+            except ValueError:
+                continue
+            # try the format that worked first for the next value
+            formats.insert(0, formats.pop(j))
+            break
+    return parsed[inverse.reshape(-1)]
+
+
+# converts a sequence of strings to a float64 array; blank or non-numeric strings become NaN
+def parse_floats(values):
+
+    try:
+        return np.array(values, dtype='float64')
+    except ValueError:
+        # parse each distinct string once
+        unique, inverse = np.unique(np.array(values, dtype=str), return_inverse=True)
+        parsed = np.empty(len(unique))
+        for i in range(len(unique)):
+            try:
+                parsed[i] = float(unique[i])
+            except ValueError:
+                parsed[i] = np.nan
+        return parsed[inverse.reshape(-1)]
+
+
+# evaluates a node of a parsed query expression over every row of a Data object at once; names are numeric column
+# headers and evaluate to the whole column as a 1-D array
+def evaluate_query(node, data):
+
+    if isinstance(node, ast.Expression):
+        return evaluate_query(node.body, data)
+    if isinstance(node, ast.Name):
+        if node.id not in data.header2matrix:
+            raise ValueError("unknown numeric column %s in query" % node.id)
+        return np.asarray(data.get_data([node.id])).reshape(-1)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.BoolOp):
+        values = [evaluate_query(value, data) for value in node.values]
+        if isinstance(node.op, ast.And):
+            return np.logical_and.reduce(values)
+        return np.logical_or.reduce(values)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in QUERY_OPERATORS:
+        return QUERY_OPERATORS[type(node.op)](evaluate_query(node.operand, data))
+    if isinstance(node, ast.BinOp) and type(node.op) in QUERY_OPERATORS:
+        return QUERY_OPERATORS[type(node.op)](evaluate_query(node.left, data), evaluate_query(node.right, data))
+    if isinstance(node, ast.Compare) and all(type(op) in QUERY_OPERATORS for op in node.ops):
+        # chained comparisons such as 0 < a <= 5 hold when every link holds
+        left = evaluate_query(node.left, data)
+        mask = True
+        for op, comparator in zip(node.ops, node.comparators):
+            right = evaluate_query(comparator, data)
+            mask = np.logical_and(mask, QUERY_OPERATORS[type(op)](left, right))
+            left = right
+        return mask
+    raise ValueError("unsupported query syntax: %s" % ast.dump(node))
+
+
+# opens a data file for reading in binary, decompressing it as it is read if it is gzip compressed
+def open_binary(filename):
+
+    fp = open(filename, 'rb')
+    if fp.peek(2)[:2] == b'\x1f\x8b':
+        fp.close()
+        return gzip.open(filename, 'rb')
+    return fp
+
+
+# reads one CSV record (as bytes) from a binary file; a record continues onto the next line while it has a quoted field
+# that is still open. As with csv.reader, a quote only starts a quoted field if it is the first character of the field
+# (after any spaces), and inside a quoted field a quote that is written twice stands for one quote
+def read_record(fp):
+
+    record = fp.readline()
+    if b'"' not in record:
+        return record
+    state = 'start'
+    line = record
+    while True:
+        for c in line:
+            if state == 'quoted':
+                if c == QUOTE_BYTE:
+                    state = 'closed'
+            elif c == COMMA_BYTE:
+                state = 'start'
+            elif state == 'start':
+                if c == QUOTE_BYTE:
+                    state = 'quoted'
+                elif c != SPACE_BYTE:
+                    state = 'unquoted'
+            elif state == 'closed':
+                # a second quote right after a closing one is an escaped quote inside the field
+                state = 'quoted' if c == QUOTE_BYTE else 'unquoted'
+        if state != 'quoted':
+            return record
+        line = fp.readline()
+        if not line:
+            return record
+        record += line
+
+
+# returns a string as a CSV field, quoting it if it contains a delimiter, a quote, a line break, or leading space
+def csv_field(value):
+
+    if value == value.lstrip() and not any(c in value for c in ',"\r\n'):
+        return value
+    return '"' + value.replace('"', '""') + '"'
+
+
+# Builds the raw row of the record that starts at a given byte offset of a CSV file; the file is opened on first use
+class FileRowReader:
+
+    # Constructor
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.fp = None
+
+    def __call__(self, offset):
+
+        if self.fp is None:
+            self.fp = open_binary(self.filename)
+        self.fp.seek(offset)
+        record = read_record(self.fp).decode('utf-8')
+        return next(csv.reader([record], delimiter=',', skipinitialspace=True))
+
+    # closes the file until the next row is asked for
+    def close(self):
+
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    # the open file handle is not sent along when the reader is pickled
+    def __getstate__(self):
+
+        return {'filename': self.filename, 'fp': None}
+
+
+# Builds a raw row of a joined Data object from a row of each of the two Data objects that were joined
+class JoinedRowReader:
+
+    # Constructor
+    # row i of the join is row leftRows[i] of left followed by the rightCols columns of row rightRows[i] of right
+    def __init__(self, left, leftRows, right, rightRows, rightCols):
+
+        self.left = left
+        self.leftRows = leftRows
+        self.right = right
+        self.rightRows = rightRows
+        self.rightCols = rightCols
+
+    def __call__(self, i):
+
+        left = self.left.get_raw_row(int(self.leftRows[i]))
+        right = self.right.get_raw_row(int(self.rightRows[i]))
+        return list(left) + [right[col] if col < len(right) else '' for col in self.rightCols]
+
+    # closes the files that the rows of the two Data objects are read from
+    def close(self):
+
+        self.left.close()
+        self.right.close()
+
+
+# An ordered list of headers together with the position of each header. It is kept up to date as headers are added and
+# removed, so the header list and the position of a header are both available without sorting. Reading it works like a
+# dictionary from header to position.
+class HeaderIndex:
+
+    # Constructor
+    def __init__(self, headers=()):
+
+        self.headers = []
+        self.positions = {}
+        for header in headers:
+            self.append(header)
+
+    # adds a header at the end
+    def append(self, header):
+
+        self.positions[header] = len(self.headers)
+        self.headers.append(header)
+
+    # removes a header, shifts the headers after it down by one, and returns its old position
+    def remove(self, header):
+
+        position = self.positions.pop(header)
+        del self.headers[position]
+        for i in range(position, len(self.headers)):
+            self.positions[self.headers[i]] = i
+        return position
+
+    def __getitem__(self, header):
+
+        return self.positions[header]
+
+    def __contains__(self, header):
+
+        return header in self.positions
+
+    def __len__(self):
+
+        return len(self.headers)
+
+    def __iter__(self):
+
+        return iter(self.headers)
+
+    def items(self):
+
+        return [(header, i) for i, header in enumerate(self.headers)]
+
+
 class Data:
 
     # Constructor
-    def __init__(self, filename=None, dataset=None):
+    # float32 stores the float columns in single precision; int columns are always stored in the smallest integer type
+    # that holds their values
+    def __init__(self, filename=None, dataset=None, cache=True, float32=False):
 
         # create and initialize fields for the class
+        self.filename = filename
+        self.float32 = float32
+        self.version = 0  # counts the changes made to the data, so results computed from it can tell if they are stale
+        self.data_cache = collections.OrderedDict()  # recent get_data results, most recently used last
+        self.validity = {}  # header -> packed bitmap of the rows that are not missing, built when first asked for
+        # string and enum columns are also stored as integer codes: categories maps a header to its table of distinct
+        # values and codes maps it to the code of each raw row
+        self.categories = {}
+        self.codes = {}
+        # date columns are also stored as datetime64 values: dates maps a header to the date of each raw row
+        # indexes maps a date or numeric header to a SortedIndex of its values once one has been created or asked for
+        self.dates = {}
+        self.indexes = {}
+        # moments maps a numeric header to its RunningMoments once track_moments has been called for it (None until
+        # the moments are next asked for, if a change could not update them)
+        self.moments = {}
         self.raw_headers = []
         self.raw_types = []
+        self.read_stats = None
+        # numeric columns are stored by type: float columns in matrix_data, int columns in int_data; header2matrix maps
+        # a header to its position in the numeric headers and header2block maps it to ('float' or 'int', column index)
+        self.int_data = np.zeros((0, 0), dtype='int8')
+        self.header2block = {}
+        self.row_buffers = {}
+        self.shared_blocks = set()  # blocks that views have been given out for
+        self.subsets = weakref.WeakSet()  # DataSubsets that still read this object's storage
         if dataset == None:
             self.raw_data = []
             self.header2raw = {}
             self.matrix_data = np.matrix([])
-            self.header2matrix = {}
+            self.header2matrix = HeaderIndex()
         else:
             self.raw_headers = dataset[0]
             self.raw_types = dataset[1]
             self.raw_data = dataset[2:]
             self.header2raw = {}
             self.matrix_data = np.matrix([])
-            self.header2matrix = {}
+            self.header2matrix = HeaderIndex()
             for i in range(len(self.raw_headers)):
                 self.header2raw[self.raw_headers[i]] = i
             return
 
         if filename != None:
-            self.read(filename)
+            self.read(filename, cache)
 
     # puts the original data in string format into a list of lists, with one sublist for each data point
-    def read(self, filename):
-
-        # make a new file reader object
-        fp = open(filename, 'rU')
-        reader = csv.reader(fp, delimiter=',', skipinitialspace=True)
-
-        # assign the headers and types
-        # .__next__() NECESSARY FOR PYTHON 3.5 -- CHANGE TO .next() FOR PYTHON 2.7
-        self.raw_headers = reader.__next__()
-        self.raw_types = reader.__next__()
+    # if cache is True, an unchanged file is loaded from its binary cache instead, and a new cache is written after parsing
+    def read(self, filename, cache=True):
+
+        start = time.time()
+        self.filename = filename
+
+        if cache and self.read_cache(filename):
+            seconds = max(time.time() - start, 1e-9)
+            self.read_stats = {'rows': self.get_num_rows(), 'seconds': seconds,
+                               'rows_per_sec': self.get_num_rows() / seconds,
+                               'mb_per_sec': os.path.getsize(filename) / 1e6 / seconds}
+            print("Loaded %i rows of %s from its cache in %.3f s." % (self.get_num_rows(), filename, seconds))
+            return
 
-        # fill in the raw data
-        for row in reader:
-            self.raw_data.append(row)
+        # the raw rows are not kept as strings; only the byte offset of each record in the file is recorded, and the
+        # rows are converted to numbers a block at a time (a record can span several lines if a quoted field has a
+        # line break in it)
+        fp = open_binary(filename)
+        self.raw_headers = next(csv.reader([read_record(fp).decode('utf-8')], delimiter=',', skipinitialspace=True))
+        self.raw_types = next(csv.reader([read_record(fp).decode('utf-8')], delimiter=',', skipinitialspace=True))
+        self.set_schema(self.raw_headers, self.raw_types)
+
+        offset = fp.tell()
+        offsets = array.array('q')
+        lines = []
+        blocks = []
+        while True:
+            record = read_record(fp)
+            if not record:
+                break
+            if record.strip():
+                offsets.append(offset)
+                lines.append(record.decode('utf-8'))
+            offset += len(record)
+            if len(lines) == READ_BLOCK_ROWS:
+                blocks.append(self.convert_numeric(list(csv.reader(lines, delimiter=',', skipinitialspace=True))))
+                lines = []
+        if len(lines) > 0 or len(blocks) == 0:
+            blocks.append(self.convert_numeric(list(csv.reader(lines, delimiter=',', skipinitialspace=True))))
+        del lines
+        fp.close()
+
+        # stack the blocks of rows into the float and int storage
+        if len(blocks) == 1:
+            floats, ints, encoded = blocks[0]
+        else:
+            floats, ints = np.vstack([x[0] for x in blocks]), np.vstack([x[1] for x in blocks])
+            encoded = {}
+            for header in blocks[0][2]:
+                encoded[header] = np.concatenate([x[2][header] for x in blocks])
+        del blocks
+        self.set_numeric(*self.move_missing_ints(floats, ints))
+        self.set_encoded(encoded)
+        del floats, ints, encoded
+        self.raw_data = LazyRows(offsets, FileRowReader(filename), self.format_raw_row)
+
+        if cache:
+            self.write_cache(filename)
+
+        # record the parse throughput so that regressions in load time are easy to spot
+        seconds = max(time.time() - start, 1e-9)
+        megabytes = os.path.getsize(filename) / 1e6
+        self.read_stats = {'rows': len(self.raw_data), 'seconds': seconds,
+                           'rows_per_sec': len(self.raw_data) / seconds, 'mb_per_sec': megabytes / seconds}
+        print("Read %i rows from %s in %.3f s (%.0f rows/s, %.2f MB/s)."
+              % (len(self.raw_data), filename, seconds, self.read_stats['rows_per_sec'], self.read_stats['mb_per_sec']))
+
+    # loads the numeric data from the binary cache of filename if the cache exists and the file has not changed since it
+    # was written (same size, modification time, and hash), and returns whether it succeeded
+    def read_cache(self, filename):
 
-        # map the headers to their column index in the raw data
-        for i in range(len(self.raw_headers)):
-            self.header2raw[self.raw_headers[i]] = i
+        try:
+            meta, arrays = read_binary(filename + CACHE_SUFFIX)
+            stat = os.stat(filename)
+            source = meta['source']
+            if source['size'] != stat.st_size or source['mtime'] != stat.st_mtime_ns:
+                return False
+            if meta['float32'] != self.float32:
+                return False
+            if meta.get('format') != CACHE_FORMAT:
+                return False
+            if source['md5'] != file_signature(filename, stat)['md5']:
+                return False
+            blocks = meta['blocks']
+            categories = meta['categories']
+            matrix = arrays['matrix']
+            ints = arrays['ints']
+            offsets = arrays['offsets']
+            codes = {}
+            for header in categories:
+                codes[header] = arrays['codes:' + header]
+            dates = {}
+            for header, type in zip(meta['headers'], meta['types']):
+                if type == DATE_TYPE:
+                    dates[header] = arrays['dates:' + header]
+        except (OSError, ValueError, KeyError):
+            return False
+
+        self.set_schema(meta['headers'], meta['types'])
+        for header, (name, col) in blocks.items():
+            self.header2block[header] = (name, col)
+        self.matrix_data = np.asmatrix(matrix)
+        self.int_data = ints
+        self.raw_data = LazyRows(offsets, FileRowReader(filename), self.format_raw_row)
+        self.categories = categories
+        self.codes = codes
+        self.dates = dates
+        return True
+
+    # writes the numeric data and its headers and types to the binary cache of filename
+    def write_cache(self, filename):
 
-        # go through each column of numeric data and convert the string data to numeric form (floats)
-        # map the headers to their column index in the numeric data
-        numeric_matrix = np.zeros((len(self.raw_data), len(self.raw_headers)), dtype='float64')
-        cols = 0
-        for i in range(len(self.raw_headers)):
-            if self.raw_types[i] == "numeric" or self.raw_types[i] == "int" or self.raw_types[i] == "float":
-                self.header2matrix[self.raw_headers[i]] = cols
-                for j in range(len(self.raw_data)):
-                    temp = copy.deepcopy(self.raw_data[j][i])
-                    numeric_matrix[j, cols] = temp
-                cols += 1
+        try:
+            meta = {'format': CACHE_FORMAT, 'source': file_signature(filename), 'headers': self.raw_headers,
+                    'types': self.raw_types,
+                    'float32': self.float32, 'blocks': self.header2block, 'categories': self.categories}
+            arrays = {'matrix': np.asarray(self.matrix_data), 'ints': self.int_data,
+                      'offsets': np.frombuffer(self.raw_data.keys, dtype='int64')}
+            for header in self.categories:
+                arrays['codes:' + header] = self.get_codes(header)
+            for header in self.dates:
+                arrays['dates:' + header] = self.get_dates(header)
+            write_binary(filename + CACHE_SUFFIX, meta, arrays)
+        except OSError:
+            print("Warning: could not write the cache for %s." % filename)
+
+    # reads a file in blocks of rows_per_chunk rows and yields each block as its own Data object with the same headers
+    # and types, so files larger than memory can be processed one block at a time
+    @staticmethod
+    def iter_chunks(filename, rows_per_chunk=100000, float32=False):
+
+        with io.TextIOWrapper(open_binary(filename), encoding='utf-8', newline='') as fp:
+            reader = csv.reader(fp, delimiter=',', skipinitialspace=True)
+            headers = reader.__next__()
+            types = reader.__next__()
+            while True:
+                rows = list(itertools.islice(reader, rows_per_chunk))
+                if len(rows) == 0:
+                    return
+                chunk = Data(float32=float32)
+                chunk.set_schema(list(headers), list(types))
+                chunk.raw_data = rows
+                floats, ints, encoded = chunk.convert_numeric(rows)
+                chunk.set_numeric(*chunk.move_missing_ints(floats, ints))
+                chunk.set_encoded(encoded)
+                yield chunk
+
+    # sets the raw headers and types and maps the headers to their column index in the raw and numeric data
+    def set_schema(self, headers, types):
+
+        self.changed()
+        self.raw_headers = headers
+        self.raw_types = types
+        self.header2raw = {}
+        self.header2matrix = HeaderIndex()
+        self.header2block = {}
+        self.categories = {}
+        self.codes = {}
+        self.dates = {}
+        self.indexes = {}
+        counts = {'float': 0, 'int': 0}
+        for i in range(len(headers)):
+            self.header2raw[headers[i]] = i
+            if types[i] in CATEGORICAL_TYPES:
+                self.categories[headers[i]] = []
+            elif types[i] == DATE_TYPE:
+                self.dates[headers[i]] = np.zeros(0, dtype=DATE_UNIT)
+            if types[i] in NUMERIC_TYPES:
+                self.header2matrix.append(headers[i])
+                block = 'int' if types[i] == 'int' else 'float'
+                self.header2block[headers[i]] = (block, counts[block])
+                counts[block] += 1
+
+    # returns the raw column indices of the headers stored in a block ('float' or 'int'), in block order
+    def block_raw_columns(self, block):
+
+        locations = sorted((col, header) for header, (name, col) in self.header2block.items() if name == block)
+        return [self.header2raw[header] for col, header in locations]
+
+    # converts the numeric columns of a list of raw rows into a float matrix and an int64 array, and converts the
+    # string and enum columns to int64 codes and the date columns to dates in a dictionary from header to array
+    # blank or non-numeric cells are missing: they are NaN in float columns and INT_MISSING in int columns
+    def convert_numeric(self, rows):
+
+        floatCols = self.block_raw_columns('float')
+        intCols = self.block_raw_columns('int')
+
+        # transpose the raw rows once, then convert each numeric column in a single call into preallocated storage
+        # instead of converting every cell separately
+        floats = np.empty((len(rows), len(floatCols)), dtype='float32' if self.float32 else 'float64')
+        ints = np.empty((len(rows), len(intCols)), dtype='int64')
+        encoded = {}
+        for header in self.categories:
+            encoded[header] = np.zeros(0, dtype='int64')
+        for header in self.dates:
+            encoded[header] = np.zeros(0, dtype=DATE_UNIT)
+        if len(rows) > 0:
+            columns = list(itertools.zip_longest(*rows, fillvalue=''))
+            for j in range(len(floatCols)):
+                floats[:, j] = parse_floats(columns[floatCols[j]])
+            for j in range(len(intCols)):
+                try:
+                    ints[:, j] = np.array(columns[intCols[j]], dtype='int64')
+                except ValueError:
+                    values = parse_floats(columns[intCols[j]])
+                    missing = np.isnan(values)
+                    if np.any(values[~missing] != np.trunc(values[~missing])):
+                        print("Warning: non-integer values in int column %s were truncated." % self.raw_headers[intCols[j]])
+                    values[missing] = 0
+                    ints[:, j] = values
+                    ints[missing, j] = INT_MISSING
+            for header in self.categories:
+                encoded[header] = encode_categories(columns[self.header2raw[header]], self.categories[header])
+            for header in self.dates:
+                encoded[header] = parse_dates(columns[self.header2raw[header]])
+            del columns
+
+        return np.matrix(floats), ints, encoded
+
+    # moves the int columns that have missing cells (INT_MISSING) to the end of the float block, where the missing cells
+    # can be NaN, and returns the new float and int blocks; the raw types of the columns stay 'int'
+    def move_missing_ints(self, floats, ints):
+
+        missing = ints == INT_MISSING
+        moved = np.flatnonzero(missing.any(axis=0))
+        if len(moved) == 0:
+            return floats, ints
+        kept = np.flatnonzero(~missing.any(axis=0))
+
+        intHeaders = sorted((col, header) for header, (name, col) in self.header2block.items() if name == 'int')
+        for k in range(len(moved)):
+            header = intHeaders[moved[k]][1]
+            self.header2block[header] = ('float', floats.shape[1] + k)
+            print("Column %s has missing values and is stored as floats." % header)
+        for k in range(len(kept)):
+            self.header2block[intHeaders[kept[k]][1]] = ('int', k)
+
+        columns = ints[:, moved].astype(floats.dtype)
+        columns[missing[:, moved]] = np.nan
+        return np.hstack((np.asarray(floats), columns)), ints[:, kept]
+
+    # stores the codes of the string and enum columns and the dates of the date columns (a dictionary from header to
+    # array), narrowing the codes to the smallest integer type that holds them
+    def set_encoded(self, encoded):
+
+        self.codes = {}
+        self.indexes = {}
+        for header in encoded:
+            if header in self.categories:
+                self.codes[header] = encoded[header].astype(smallest_int_type(encoded[header]), copy=False)
+            else:
+                self.dates[header] = encoded[header]
+
+    # stores the float and int blocks of the numeric data, narrowing the ints to the smallest type that holds them
+    def set_numeric(self, floats, ints):
+
+        self.changed()
+        self.drop_indexes(self.get_headers())
+        self.stale_moments(self.get_headers())
+        self.matrix_data = np.asmatrix(floats)
+        self.int_data = ints.astype(smallest_int_type(ints), copy=False)
+
+    # returns a storage block ('float' or 'int') as a 2D array
+    def block(self, name):
+
+        return np.asarray(self.matrix_data) if name == 'float' else self.int_data
+
+    # widens the int block if needed so that it can hold the given values
+    def fit_ints(self, values):
+
+        values = np.asarray(values)
+        if values.size == 0:
+            return
+        needed = smallest_int_type(np.trunc(values.astype('float64')).astype('int64'))
+        dtype = np.promote_types(self.int_data.dtype, needed)
+        if dtype != self.int_data.dtype:
+            self.int_data = self.int_data.astype(dtype)
 
-        # delete any other columns that were copied over
-        if cols < len(self.raw_headers):
-            numeric_matrix = numeric_matrix[:, :cols]
+    # returns the parse statistics (rows, seconds, rows_per_sec, mb_per_sec) of the last call to read
+    def get_read_stats(self):
 
-        # copy the matrix data to self.matrix_data and free some memory
-        self.matrix_data = np.matrix(numeric_matrix)
-        del numeric_matrix
+        return self.read_stats
 
     # returns a list of all of the headers in the raw data
     def get_raw_headers(self):
@@ -117,6 +912,7 @@ class Data:
         column = []
         for row in self.raw_data:
             column.append(row[col])
+        self.close()
 
         return column
 
@@ -142,65 +938,314 @@ class Data:
             for j in range(len(colHeaders)):
                 header = self.header2raw[colHeaders[j]]
                 raw_data_matrix[i-rowRange[0], j] = str(self.raw_data[i][header]) # adjust to fit regular matrices
+        self.close()
 
         return raw_data_matrix
 
+    # returns a list of the headers of the string and enum columns, which are stored as integer codes
+    def get_categorical_headers(self):
+
+        return list(self.categories)
+
+    # returns the table of distinct values of a string or enum column; a code is the index of its value in the table
+    def get_categories(self, colHeader):
+
+        return self.categories[colHeader]
+
+    # returns the codes of a string or enum column as an N x 1 matrix, which can be used as the categories of the
+    # classifiers and of kmeans; raw rows added since the codes were made are encoded first
+    def get_codes(self, colHeader):
+
+        table = self.categories[colHeader]
+        codes = self.codes.get(colHeader, np.zeros(0, dtype='int8'))
+        if len(codes) < len(self.raw_data):
+            col = self.header2raw[colHeader]
+            added = encode_categories([self.raw_data[i][col] for i in range(len(codes), len(self.raw_data))], table)
+            codes = np.concatenate((codes, added))
+            codes = codes.astype(smallest_int_type(codes), copy=False)
+            self.codes[colHeader] = codes
+        return np.asmatrix(codes.reshape(-1, 1))
+
+    # returns a list of the headers of the date columns
+    def get_date_headers(self):
+
+        return list(self.dates)
+
+    # returns the dates of a date column as a DATE_UNIT array (NaT where a date is missing); raw rows added since the
+    # dates were parsed are parsed first
+    def get_dates(self, colHeader):
+
+        dates = self.dates[colHeader]
+        if len(dates) < len(self.raw_data):
+            col = self.header2raw[colHeader]
+            added = parse_dates([self.raw_data[i][col] for i in range(len(dates), len(self.raw_data))])
+            dates = np.concatenate((dates, added))
+            self.dates[colHeader] = dates
+        return dates
+
+    # returns the indices (in increasing order) of the rows whose date in a date column is between start and end,
+    # inclusive; start and end are dates or strings such as '2010-07-01', and either can be None to leave that end open.
+    # The first query builds a sorted index of the column, so each query is then two binary searches; pass the result
+    # to where to get the rows as a Data object
+    def rows_between(self, colHeader, start=None, end=None):
+
+        if colHeader not in self.indexes or len(self.indexes[colHeader]) != len(self.get_dates(colHeader)):
+            self.indexes[colHeader] = SortedIndex(self.get_dates(colHeader))
+        start = None if start is None else np.datetime64(start, 's')
+        end = None if end is None else np.datetime64(end, 's')
+        return self.indexes[colHeader].between(start, end)
+
+    # builds a sorted index of a numeric column so that range_rows can answer with binary searches; the index is kept
+    # up to date when rows are added, and other changes to the column drop it until the next query rebuilds it
+    def create_index(self, colHeader):
+
+        self.indexes[colHeader] = SortedIndex(np.asarray(self.get_data([colHeader])).reshape(-1))
+        return self.indexes[colHeader]
+
+    # returns the indices (in increasing order) of the rows whose value in a numeric column is between low and high,
+    # inclusive (missing values are never in range); either can be None to leave that end open. With an index (built
+    # by create_index or by the first query) this is two binary searches plus the matching rows
+    def range_rows(self, colHeader, low=None, high=None):
+
+        if colHeader not in self.indexes:
+            self.create_index(colHeader)
+        return self.indexes[colHeader].between(low, high)
+
+    # drops the sorted indexes of the given columns
+    def drop_indexes(self, colHeaders):
+
+        for header in colHeaders:
+            self.indexes.pop(header, None)
+
+    # starts keeping running moments (count, mean, M2, min, max) of numeric columns, all of them by default; adding rows,
+    # deleting rows, and setting values then update the moments in O(1) per value instead of rescanning the column
+    def track_moments(self, colHeaders=None):
+
+        for header in (self.get_headers() if colHeaders is None else colHeaders):
+            if header not in self.moments:
+                self.moments[header] = None
+
+    # returns the count, mean, M2, min, and max (each an array with one value per column, skipping missing values) of
+    # columns whose moments are tracked, or None if any of them is not tracked
+    def get_moments(self, colHeaders):
+
+        if any(header not in self.moments for header in colHeaders):
+            return None
+        for header in colHeaders:
+            if self.moments[header] is None:
+                self.moments[header] = RunningMoments(self.get_data([header]))
+        moments = [self.moments[header] for header in colHeaders]
+        count = np.array([m.count for m in moments], dtype='float64')
+        empty = count == 0
+        stats = [count]
+        for field in ('mean', 'm2', 'min', 'max'):
+            values = np.array([getattr(m, field) for m in moments], dtype='float64')
+            values[empty] = np.nan
+            stats.append(values)
+        return tuple(stats)
+
+    # marks the tracked moments of the given columns to be rebuilt the next time they are asked for
+    def stale_moments(self, colHeaders):
+
+        for header in colHeaders:
+            if header in self.moments:
+                self.moments[header] = None
+
+    # updates the tracked moments of a column after one of its values changed from old to new
+    def update_moments(self, colHeader, old, new):
+
+        moments = self.moments.get(colHeader)
+        if moments is None:
+            return
+        if moments.remove(old):
+            moments.add(new)
+        else:
+            self.moments[colHeader] = None
+
     # returns a list of all of the headers in the numeric data
     def get_headers(self):
 
-        # return list(self.header2matrix.keys())
-        return [x[0] for x in sorted(self.header2matrix.items(), key=operator.itemgetter(1))]
+        return self.header2matrix.headers
 
     # returns the number of columns in the numeric data set
     def get_num_columns(self):
 
-        return self.matrix_data.shape[0]
+        return len(self.header2matrix)
 
     # returns the number of rows in the numeric data set
     def get_num_rows(self):
 
-        return self.matrix_data.shape[1]
+        if len(self.header2block) == 0:
+            return 0
+        block, col = next(iter(self.header2block.values()))
+        return self.block(block).shape[0]
 
     # returns a row of data (the type is list) given a row index (int) in the numeric data
     def get_row(self, row):
 
-        return self.matrix_data[row, :]
+        return self.get_data(self.get_headers(), [row])
 
     # returns a column of data (the type is list) given a column header (string) in the numeric data
     def get_column(self, colHeader):
 
-        if type(colHeader) == str:
-            return self.matrix_data[:, self.header2matrix[colHeader]]
-        elif type(colHeader) == int:
-            return self.matrix_data[:, colHeader]
-        else:
+        if type(colHeader) == int:
+            colHeader = self.get_headers()[colHeader]
+        elif type(colHeader) != str:
             return
+        block, col = self.header2block[colHeader]
+        return self.block_view(block, col, col + 1)
 
     # takes a row index (an int) and column header (a string) and returns the numeric data (a float) at that location
     def get_value(self, row, colHeader):
 
-        return self.matrix_data[row, self.header2matrix[colHeader]]
+        block, col = self.header2block[colHeader]
+        return self.block(block)[row, col]
 
     # takes a list of column headers and return a matrix with the numeric data for all rows but just the specified
     # columns, optional to also allow the caller to specify a specific set of rows
-    # start index and stop index?
-    def get_data(self, colHeaders, rows=None):
-
-        if rows != None:
-            rowRange = np.array(rows)
+    # the matrix keeps the stored type of the columns (int columns stay integers unless mixed with float columns);
+    # pass a dtype such as 'float64' to convert it
+    # results for all rows are kept in a small least-recently-used cache until the data is changed, so they are returned
+    # read-only
+    def get_data(self, colHeaders, rows=None, dtype=None):
+
+        key = (tuple(colHeaders), None if dtype is None else np.dtype(dtype).str)
+        if rows is None and key in self.data_cache:
+            self.data_cache.move_to_end(key)
+            return self.data_cache[key]
+
+        # headers that sit next to each other in one block are returned as a read-only view without copying
+        locations = [self.header2block[colHeader] for colHeader in colHeaders]
+        names = set(block for block, col in locations)
+        if rows is None and len(names) == 1 and len(locations) > 0:
+            name, first = locations[0]
+            if ([col for block, col in locations] == list(range(first, first + len(locations))) and
+                    (dtype is None or np.dtype(dtype) == self.block(name).dtype)):
+                return self.block_view(name, first, first + len(locations))
+
+        # otherwise gather the columns from each block with a single take into contiguous memory
+        if len(names) <= 1:
+            block = self.block(names.pop() if names else 'float')
+            cols = [col for name, col in locations]
+            if rows is None:
+                matrix = np.take(block, cols, axis=1)
+            else:
+                matrix = block[np.ix_(np.asarray(rows).reshape(-1), cols)]
         else:
-            rowRange = np.arange(len(self.matrix_data))
-
-        headers = [self.header2matrix[colHeader] for colHeader in colHeaders]
-        matrix = np.hstack((self.matrix_data[rowRange, col] for col in headers))
+            rowRange = slice(None) if rows is None else np.asarray(rows).reshape(-1)
+            n = self.get_num_rows() if rows is None else len(rowRange)
+            matrix = np.empty((n, len(locations)), dtype=np.result_type(self.matrix_data, self.int_data))
+            for name in names:
+                positions = [j for j in range(len(locations)) if locations[j][0] == name]
+                cols = [locations[j][1] for j in positions]
+                if rows is None:
+                    matrix[:, positions] = np.take(self.block(name), cols, axis=1)
+                else:
+                    matrix[:, positions] = self.block(name)[np.ix_(rowRange, cols)]
+
+        if dtype is not None:
+            matrix = matrix.astype(dtype, copy=False)
+        matrix = np.asmatrix(matrix)
+
+        if rows is None:
+            matrix.flags.writeable = False
+            self.data_cache[key] = matrix
+            while (len(self.data_cache) > DATA_CACHE_ENTRIES or
+                   (len(self.data_cache) > 1 and sum(x.nbytes for x in self.data_cache.values()) > DATA_CACHE_BYTES)):
+                self.data_cache.popitem(last=False)
         return matrix
 
+    # returns a boolean array that is True for the rows where a numeric column is not missing (NaN); the bitmap of each
+    # column is packed to one bit per row and kept until the data is changed
+    def get_valid(self, colHeader):
+
+        n = self.get_num_rows()
+        if colHeader not in self.validity:
+            column = np.asarray(self.get_data([colHeader])).reshape(-1)
+            if np.issubdtype(column.dtype, np.floating):
+                self.validity[colHeader] = np.packbits(~np.isnan(column))
+            else:
+                self.validity[colHeader] = None  # int columns cannot have missing values
+        if self.validity[colHeader] is None:
+            return np.ones(n, dtype=bool)
+        return np.unpackbits(self.validity[colHeader], count=n).astype(bool)
+
+    # returns the number of missing values in each of the given numeric columns
+    def count_missing(self, colHeaders):
+
+        return [self.get_num_rows() - int(np.count_nonzero(self.get_valid(header))) for header in colHeaders]
+
+    # returns a read-only view of columns start to stop of a block ('float' or 'int') as a matrix; the block is then
+    # shared, so the next change made to it in place copies it first and the view keeps the old values
+    def block_view(self, name, start, stop):
+
+        view = np.asmatrix(self.block(name)[:, start:stop])
+        view.flags.writeable = False
+        self.shared_blocks.add(name)
+        return view
+
+    # returns a block ('float' or 'int') that can be changed in place, copying it first if views of it have been given out
+    def writable_block(self, name):
+
+        if name in self.shared_blocks:
+            self.shared_blocks.discard(name)
+            if name == 'float':
+                self.matrix_data = np.asmatrix(np.array(self.matrix_data))
+            else:
+                self.int_data = np.array(self.int_data)
+        return self.block(name)
+
+    # clears everything derived from the data and counts a new version; called by every method that changes the data,
+    # before it changes anything, so the subsets that read this object's storage are first given their own copy
+    def changed(self):
+
+        for subset in list(self.subsets):
+            subset.changed()
+        self.version += 1
+        self.data_cache.clear()
+        self.validity.clear()
+
+    # returns the version of the data, which is different after every change
+    def get_version(self):
+
+        return self.version
+
+    # closes the file that the raw rows are read from, if one is open; methods that read many raw rows close it when they
+    # are done, and it is opened again when another raw row is asked for
+    def close(self):
+
+        if isinstance(self.raw_data, LazyRows) and hasattr(self.raw_data.fetch, 'close'):
+            self.raw_data.fetch.close()
+
+    # the subsets are not sent along when the data is pickled
+    def __getstate__(self):
+
+        state = dict(self.__dict__)
+        del state['subsets']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.subsets = weakref.WeakSet()
+
     # updates a row of raw data in the Data object
     def set_raw_row(self, data, row):
 
+        self.changed()
         try:
             for i in range(len(data)):
                 self.raw_data[row][i] = data[i]
+            for header in self.codes:
+                if row < len(self.codes[header]):
+                    code = encode_categories([self.raw_data[row][self.header2raw[header]]], self.categories[header])
+                    codes = self.codes[header]
+                    self.codes[header] = codes.astype(np.promote_types(codes.dtype, smallest_int_type(code)), copy=False)
+                    self.codes[header][row] = code[0]
+            for header in self.dates:
+                if row < len(self.dates[header]):
+                    self.dates[header][row] = parse_dates([self.raw_data[row][self.header2raw[header]]])[0]
+                    self.indexes.pop(header, None)
             print("Row %i updated in raw data." % row)
         except: print("Error: index out of bounds. Row %i not updated." % row)
 
@@ -209,40 +1254,63 @@ class Data:
     # updates a row of numeric data in the Data object
     def set_row(self, data, row):
 
+        self.changed()
         try:
-            self.matrix_data[row, :] = data
+            values = np.asarray(data).reshape(-1)
+            if len(values) != len(self.header2matrix):
+                raise ValueError
+            self.drop_indexes(self.get_headers())
+            for header, (block, col) in self.header2block.items():
+                if block == 'int':
+                    self.fit_ints(values[self.header2matrix[header]])
+                old = self.block(block)[row, col]
+                self.writable_block(block)[row, col] = values[self.header2matrix[header]]
+                self.update_moments(header, old, self.block(block)[row, col])
             print("Row %i updated in numeric data." % row)
         except: print("Error: index out of bounds. Row %i not updated." % row)
 
     # updates a column of data in the Data object
     def set_column(self, data, colHeader, type=None):
 
-        numCol = self.header2matrix[colHeader]
+        self.changed()
+        block, col = self.header2block[colHeader]
         rawCol = self.header2raw[colHeader]
+        self.drop_indexes([colHeader])
+        self.stale_moments([colHeader])
         if type != None:
             self.raw_types[rawCol] = type
         try:
-            for i in range(len(self.matrix_data)):
-                self.raw_data[i][rawCol] = str(np.array(data[i])[0, 0])
-            self.matrix_data[:, numCol] = data
-            print("Column %s updated.")
+            values = np.asarray(data).reshape(-1)
+            for i in range(self.get_num_rows()):
+                self.raw_data[i][rawCol] = str(values[i])
+            if block == 'int':
+                self.fit_ints(values)
+            self.writable_block(block)[:, col] = values
+            print("Column %s updated." % colHeader)
         except: print("Error: improper column title. Column '%s' not updated." % colHeader)
 
     # updates an individual value in the Data object
     def set_value(self, value, row, colHeader):
 
-        numCol = self.header2matrix[colHeader]
+        self.changed()
+        block, col = self.header2block[colHeader]
         rawCol = self.header2raw[colHeader]
+        self.drop_indexes([colHeader])
         try:
-            self.matrix_data[row, numCol] = value
+            if block == 'int':
+                self.fit_ints(value)
+            old = self.block(block)[row, col]
+            self.writable_block(block)[row, col] = value
+            self.update_moments(colHeader, old, self.block(block)[row, col])
             self.raw_data[row][rawCol] = str(value)
-            print("Value (%i, '%s') updated to ", value, "." % row, colHeader, value)
+            print("Value (%i, '%s') updated to %s." % (row, colHeader, value))
         except: print("Error: index out of bounds or improper column title. Value ", value, " not updated.")
 
     # adds a row of raw data to the Data object
     def add_raw_row(self, data):
         # incorporate type checking to allow each column in the row to be the correct type and prevent data from being
         # added if that's not the case
+        self.changed()
         try:
             if len(data) != len(self.raw_headers):
                 print("Error: improper data dimensions. Row not added.")
@@ -257,23 +1325,104 @@ class Data:
     # adds a row of numeric data to the Data object
     def add_row(self, data):
 
+        self.add_rows(np.asarray(data).reshape(1, -1))
+
+    # adds a block of rows of numeric data (one row per data point) to the Data object and keeps the raw data in sync
+    # rows are copied into a buffer that doubles in size when it fills up, so adding N rows costs O(N) copying in total
+    def add_rows(self, data):
+
+        self.changed()
         try:
-            self.matrix_data = np.vstack((self.matrix_data, np.array(data)))
-            print("Row added to numeric data.")
-        except:
-            print("Error: improper data dimensions. Row not added.")
+            values = np.asarray(data)
+            if values.ndim != 2 or values.shape[1] != len(self.header2matrix):
+                raise ValueError
+        except ValueError:
+            print("Error: improper data dimensions. Rows not added.")
+            return
+
+        first = self.get_num_rows()
+        for name in ('float', 'int'):
+            rows = values[:, self.block_positions(name)]
+            if name == 'int':
+                self.fit_ints(rows)
+            self.append_block_rows(name, rows)
+        for header in self.header2matrix:
+            if header in self.indexes:
+                self.indexes[header].append(self.get_data([header], range(first, first + values.shape[0])))
+            if self.moments.get(header) is not None:
+                self.moments[header].add(self.get_data([header], range(first, first + values.shape[0])))
+
+        # the raw rows of the new data points are only built from the numeric data if they are asked for
+        if isinstance(self.raw_data, LazyRows):
+            self.raw_data.extend_unbuilt(values.shape[0])
+        else:
+            for i in range(first, first + values.shape[0]):
+                self.raw_data.append(self.format_raw_row(i))
+
+    # returns the positions in the numeric headers of the columns stored in a block ('float' or 'int'), in block order
+    def block_positions(self, block):
+
+        locations = sorted((col, self.header2matrix[header]) for header, (name, col) in self.header2block.items()
+                           if name == block)
+        return [position for col, position in locations]
+
+    # appends rows to a block, growing the block's row buffer geometrically when it runs out of room
+    def append_block_rows(self, name, rows):
+
+        block = self.block(name)
+        n = block.shape[0]
+        needed = n + rows.shape[0]
+        buffer = self.row_buffers.get(name)
+
+        # the block can only grow in place if it is still the start of its buffer; other changes replace the block
+        inPlace = (buffer is not None and buffer.dtype == block.dtype and buffer.shape[1] == block.shape[1] and
+                   block.flags['C_CONTIGUOUS'] and
+                   block.__array_interface__['data'][0] == buffer.__array_interface__['data'][0])
+        if not inPlace or needed > buffer.shape[0]:
+            grown = np.empty((max(2 * needed, 16), block.shape[1]), dtype=block.dtype)
+            grown[:n] = block
+            buffer = grown
+            self.row_buffers[name] = buffer
+        buffer[n:needed] = rows
+
+        if name == 'float':
+            self.matrix_data = np.asmatrix(buffer[:needed])
+        else:
+            self.int_data = buffer[:needed]
+
+    # builds the raw strings for a row of the numeric, category, and date data (other columns are left empty)
+    def format_raw_row(self, row):
+
+        raw = [''] * len(self.raw_headers)
+        for header in self.header2matrix:
+            value = self.get_value(row, header)
+            raw[self.header2raw[header]] = '' if value != value else str(value)
+        for header in self.codes:
+            if row < len(self.codes[header]):
+                raw[self.header2raw[header]] = self.categories[header][self.codes[header][row]]
+        for header in self.dates:
+            if row < len(self.dates[header]) and not np.isnat(self.dates[header][row]):
+                raw[self.header2raw[header]] = str(self.dates[header][row])
+        return raw
 
     # adds a column of data to the Data object
     def add_column(self, data, colHeader, type):
 
+        self.changed()
         try:
             self.raw_headers.append(colHeader)
             self.raw_types.append(type)
             self.header2raw[colHeader] = len(self.header2raw)
-            if type == 'numeric' or type == 'int' or type == 'float':
-                self.header2matrix[colHeader] = len(self.header2matrix)
-                newdata = np.array(data).reshape(len(self.matrix_data), 1)
-                self.matrix_data = np.hstack([self.matrix_data, newdata])
+            if type in NUMERIC_TYPES:
+                newdata = np.asarray(data).reshape(self.get_num_rows(), 1)
+                if type == 'int':
+                    self.fit_ints(newdata)
+                    self.header2block[colHeader] = ('int', self.int_data.shape[1])
+                    self.int_data = np.hstack([self.int_data, newdata.astype(self.int_data.dtype)])
+                else:
+                    self.header2block[colHeader] = ('float', self.matrix_data.shape[1])
+                    self.matrix_data = np.hstack([self.matrix_data, newdata.astype(self.matrix_data.dtype)])
+                self.header2matrix.append(colHeader)
             # ADD BACK IN
             # for i in range(len(self.raw_data)): # modify so that individual values are added rather than one-element matrices
             #     self.raw_data[i].append(str(np.array(data[i])[0, 0]))
@@ -283,40 +1432,411 @@ class Data:
     # deletes a row of data from the Data object
     def delete_row(self, row):
 
+        self.changed()
         try:
+            old = dict((header, self.get_value(row, header)) for header in self.moments)
             self.matrix_data = np.delete(self.matrix_data, row, axis=0)
+            self.int_data = np.delete(self.int_data, row, axis=0)
             del self.raw_data[row]
+            for header in self.codes:
+                if row < len(self.codes[header]):
+                    self.codes[header] = np.delete(self.codes[header], row)
+            for header in self.dates:
+                if row < len(self.dates[header]):
+                    self.dates[header] = np.delete(self.dates[header], row)
+            self.indexes = {}
+            for header in old:
+                moments = self.moments[header]
+                if moments is not None and not moments.remove(old[header]):
+                    self.moments[header] = None
             print ("Row %i deleted." % row)
         except: print("Error: index out of bounds. Row %i not deleted." % row)
 
     # deletes a column of data from the Data object
     def delete_column(self, colHeader):
 
+        self.changed()
         try:
-            try:
-                numCol = self.header2matrix[colHeader]
-                del self.header2matrix[colHeader]
-                self.matrix_data = np.delete(self.matrix_data, numCol, axis=1)
-            except KeyError:
-                pass
+            if colHeader in self.header2matrix:
+                self.header2matrix.remove(colHeader)
+                block, col = self.header2block.pop(colHeader)
+                if block == 'int':
+                    self.int_data = np.delete(self.int_data, col, axis=1)
+                else:
+                    self.matrix_data = np.delete(self.matrix_data, col, axis=1)
+                # shift the block columns that came after the deleted one
+                for header in self.header2matrix:
+                    if self.header2block[header][0] == block and self.header2block[header][1] > col:
+                        self.header2block[header] = (block, self.header2block[header][1] - 1)
             rawCol = self.header2raw[colHeader]
+            self.categories.pop(colHeader, None)
+            self.codes.pop(colHeader, None)
+            self.dates.pop(colHeader, None)
+            self.indexes.pop(colHeader, None)
+            self.moments.pop(colHeader, None)
             del self.raw_headers[rawCol]
             del self.raw_types[rawCol]
             del self.header2raw[colHeader]
-            for i in range(len(self.raw_data)):
-                del self.raw_data[i][rawCol]
+            for header in self.header2raw:
+                if self.header2raw[header] > rawCol:
+                    self.header2raw[header] -= 1
+            if isinstance(self.raw_data, LazyRows):
+                self.raw_data.delete_column(rawCol)
+            else:
+                for i in range(len(self.raw_data)):
+                    del self.raw_data[i][rawCol]
             print("Column %s deleted." % colHeader)
         except: print("Error: improper column title. Column %s not deleted." % colHeader)
 
+    # returns a DataSubset of the rows for which a query over the numeric columns holds, such as
+    # 'Volume > 1e6 and Open < Close'; the query may use the numeric headers, numbers, arithmetic, comparisons, and
+    # and/or/not, and it is evaluated for all rows at once. A boolean mask or a list of row indices can be given instead
+    def where(self, query):
+
+        if isinstance(query, str):
+            mask = evaluate_query(ast.parse(query, mode='eval'), self)
+            mask = np.broadcast_to(np.asarray(mask, dtype=bool), (self.get_num_rows(),))
+            rows = np.flatnonzero(mask)
+        else:
+            rows = np.asarray(query).reshape(-1)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+        return DataSubset(self, rows.astype('int64'))
+
+    # returns a GroupBy of the given numeric columns (all other numeric columns by default) grouped by the values of a
+    # key column; the key can be a numeric or a raw column
+    def groupby(self, keyHeader, colHeaders=None):
+
+        if colHeaders is None:
+            colHeaders = [header for header in self.get_headers() if header != keyHeader]
+        if keyHeader in self.categories:
+            # group by the codes and label the groups with their values
+            groups = GroupBy(self.get_codes(keyHeader), self.get_data(colHeaders, dtype='float64'), colHeaders)
+            groups.keys = np.array(self.categories[keyHeader])[groups.keys]
+            return groups
+        if keyHeader in self.header2matrix:
+            keys = np.asarray(self.get_data([keyHeader])).reshape(-1)
+        else:
+            keys = np.array(self.get_raw_column(keyHeader))
+        return GroupBy(keys, self.get_data(colHeaders, dtype='float64'), colHeaders)
+
+    # returns a new Data object with the columns of this one followed by the columns of other
+    # with on=None the rows are matched by position, and both objects must have the same number of rows; otherwise on
+    # is a header in both, its values are hashed once, and each row is matched to the row of other with the same key
+    # (rows without a match are left out, and the key column of other is not repeated). Headers of other that are
+    # already used get suffix added. Each column is copied once, straight into the storage of the new object
+    def join(self, other, on=None, suffix='_2'):
+
+        n = self.get_num_rows() if len(self.header2matrix) > 0 else len(self.raw_data)
+        if on is None:
+            m = other.get_num_rows() if len(other.header2matrix) > 0 else len(other.raw_data)
+            if m != n:
+                print("Error: cannot join %i rows to %i rows by position." % (m, n))
+                return None
+            leftRows = np.arange(n)
+            rightRows = np.arange(n)
+        else:
+            try:
+                leftKeys = self.key_values(on)
+                rightKeys = other.key_values(on)
+            except KeyError:
+                print("Error: %s is not a column of both data sets." % on)
+                return None
+            index = {}
+            for j, key in enumerate(rightKeys):
+                if key in index:
+                    print("Error: key %s appears more than once in the joined data." % key)
+                    return None
+                index[key] = j
+            matches = np.array([index.get(key, -1) for key in leftKeys], dtype='int64').reshape(-1)
+            leftRows = np.flatnonzero(matches >= 0)
+            rightRows = matches[leftRows]
+            if len(leftRows) < n:
+                print("Warning: %i of %i rows have no match and were left out of the join." % (n - len(leftRows), n))
+
+        # the new headers, with the columns of other renamed if their headers are taken
+        rightHeaders = [header for header in other.raw_headers if header != on]
+        names = {}
+        for header in rightHeaders:
+            names[header] = header + suffix if header in self.header2raw else header
+        headers = list(self.raw_headers) + [names[header] for header in rightHeaders]
+        types = list(self.raw_types) + [other.raw_types[other.header2raw[header]] for header in rightHeaders]
+        joined = Data(float32=self.float32)
+        joined.set_schema(headers, types)
+
+        # put each numeric column in the same kind of block as its source, then gather it into the new blocks
+        sources = [(self, header, header, leftRows) for header in self.get_headers()]
+        sources += [(other, header, names[header], rightRows) for header in other.get_headers() if header != on]
+        joined.header2matrix = HeaderIndex([name for source, header, name, rows in sources])
+        counts = {'float': 0, 'int': 0}
+        for source, header, name, rows in sources:
+            block = source.header2block[header][0]
+            joined.header2block[name] = (block, counts[block])
+            counts[block] += 1
+        floats = np.empty((len(leftRows), counts['float']), dtype='float32' if self.float32 else 'float64')
+        ints = np.empty((len(leftRows), counts['int']), dtype=np.result_type(self.int_data, other.int_data))
+        for source, header, name, rows in sources:
+            block, col = joined.header2block[name]
+            target = floats if block == 'float' else ints
+            target[:, col] = np.asarray(source.get_data([header], rows)).reshape(-1)
+        joined.set_numeric(floats, ints)
+
+        for source, header, name, rows in [(self, header, header, leftRows) for header in self.raw_headers] + \
+                                          [(other, header, names[header], rightRows) for header in rightHeaders]:
+            if name in joined.categories and header in source.categories:
+                joined.categories[name] = list(source.categories[header])
+                codes = np.asarray(source.get_codes(header)).reshape(-1)[rows]
+                joined.codes[name] = codes.astype(smallest_int_type(codes), copy=False)
+            elif name in joined.dates and header in source.dates:
+                joined.dates[name] = source.get_dates(header)[rows]
+
+        rightCols = [other.header2raw[header] for header in rightHeaders]
+        joined.raw_data = LazyRows(np.arange(len(leftRows)), JoinedRowReader(self, leftRows, other, rightRows, rightCols),
+                                   joined.format_raw_row)
+        return joined
+
+    # returns the values of a column as a list of hashable keys: numbers for numeric columns, dates for date columns,
+    # and strings for the others
+    def key_values(self, colHeader):
+
+        if colHeader in self.header2matrix:
+            return np.asarray(self.get_data([colHeader])).reshape(-1).tolist()
+        if colHeader in self.categories:
+            table = self.categories[colHeader]
+            return [table[code] for code in np.asarray(self.get_codes(colHeader)).reshape(-1).tolist()]
+        if colHeader in self.dates:
+            return self.get_dates(colHeader).tolist()
+        return self.get_raw_column(colHeader)
+
+    # returns a DataBatch that queues column adds and drops, row deletes, and value sets and then applies all of them
+    # with a single rebuild of the numeric and raw data; use it in a with statement or call its apply method
+    def batch(self):
+
+        return DataBatch(self)
+
+    # applies a set of changes in one pass: deletes the given rows and columns, adds the given columns (a list of
+    # (data, header, type) tuples), and sets the given values (a list of (value, row, header) tuples)
+    # row indices and added column data refer to the rows as they are before any of the changes
+    def apply_changes(self, deleteRows=(), deleteColumns=(), addColumns=(), setValues=()):
+
+        self.changed()
+        n = self.get_num_rows()
+        deleteColumns = set(deleteColumns)
+        added = {}
+        for data, colHeader, type in addColumns:
+            # copied, so that values set in the batch can be written into it
+            dtype = None if type == 'int' else 'float64' if type in NUMERIC_TYPES else object
+            added[colHeader] = (np.array(data, dtype=dtype).reshape(-1), type)
+        try:
+            keep = np.ones(n, dtype=bool)
+            keep[np.asarray(list(deleteRows), dtype='int64')] = False
+            for colHeader in deleteColumns:
+                self.header2raw[colHeader]
+            for colHeader in added:
+                if len(added[colHeader][0]) != n or colHeader in self.header2raw:
+                    raise ValueError
+            for value, row, colHeader in setValues:
+                keep[row]
+                if colHeader not in self.header2matrix and colHeader not in added:
+                    raise KeyError
+        except (IndexError, KeyError, ValueError):
+            print("Error: improper row, column, or data dimensions in batch. No changes applied.")
+            return
+
+        # values set in new columns go into their data, so the numeric blocks and the raw strings are built with them
+        for value, row, colHeader in setValues:
+            if colHeader in added:
+                added[colHeader][0][row] = value
+
+        rows = np.flatnonzero(keep)
+        newRow = np.cumsum(keep) - 1
+
+        # the remaining numeric headers keep their order and the new numeric columns go at the end
+        headers = [header for header in self.get_headers() if header not in deleteColumns]
+        headers += [header for header in added if added[header][1] in NUMERIC_TYPES]
+        header2matrix = HeaderIndex(headers)
+        header2block = {}
+        parts = {'float': [], 'int': []}
+        for header in headers:
+            if header in self.header2block:
+                block = self.header2block[header][0]
+            else:
+                block = 'int' if added[header][1] == 'int' else 'float'
+            header2block[header] = (block, len(parts[block]))
+            parts[block].append(header)
+
+        # gather each block's remaining rows and columns in one take and fill in the new columns and values
+        blocks = {}
+        for name in ('float', 'int'):
+            old = [self.header2block[header][1] for header in parts[name] if header in self.header2block]
+            block = np.empty((len(rows), len(parts[name])), dtype='int64' if name == 'int' else self.block(name).dtype)
+            block[:, :len(old)] = self.block(name)[np.ix_(rows, old)]
+            for j in range(len(old), len(parts[name])):
+                block[:, j] = added[parts[name][j]][0][rows]
+            blocks[name] = block
+        for value, row, colHeader in setValues:
+            if keep[row] and colHeader in header2block:
+                name, col = header2block[colHeader]
+                blocks[name][newRow[row], col] = value
+        self.header2matrix = header2matrix
+        self.header2block = header2block
+        self.set_numeric(blocks['float'], blocks['int'])
+
+        # rebuild the codes, dates, raw headers, types, and rows
+        for colHeader in deleteColumns:
+            self.categories.pop(colHeader, None)
+            self.codes.pop(colHeader, None)
+            self.dates.pop(colHeader, None)
+            self.moments.pop(colHeader, None)
+        for colHeader in self.codes:
+            codes = self.codes[colHeader]
+            self.codes[colHeader] = codes[keep[:len(codes)]]
+        for colHeader in self.dates:
+            dates = self.dates[colHeader]
+            self.dates[colHeader] = dates[keep[:len(dates)]]
+        self.indexes = {}
+        keepCols = [i for i in range(len(self.raw_headers)) if self.raw_headers[i] not in deleteColumns]
+        addedRaw = [np.array(['' if value != value else str(value) for value in added[header][0][rows]], dtype=str)
+                    for header in added]
+        if isinstance(self.raw_data, LazyRows):
+            self.raw_data.keep(keep)
+            for col in sorted(set(range(len(self.raw_headers))) - set(keepCols), reverse=True):
+                self.raw_data.delete_column(col)
+            for values in addedRaw:
+                self.raw_data.add_column(values)
+        else:
+            self.raw_data = [[row[col] for col in keepCols] + [str(values[i]) for values in addedRaw]
+                             for i, row in enumerate(itertools.compress(self.raw_data, keep))]
+        self.raw_headers = [self.raw_headers[col] for col in keepCols] + list(added)
+        self.raw_types = [self.raw_types[col] for col in keepCols] + [added[header][1] for header in added]
+        self.header2raw = {}
+        for i in range(len(self.raw_headers)):
+            self.header2raw[self.raw_headers[i]] = i
+        for value, row, colHeader in setValues:
+            if keep[row] and colHeader not in added:
+                self.raw_data[newRow[row]][self.header2raw[colHeader]] = str(value)
+
     # prints out the data to the command line
     def printData(self, numRows=999999):
 
         print("\n\nData:")
         print(self.raw_headers)
         print(self.raw_types)
-        print(self.matrix_data[:numRows, :])
+        print(self.get_data(self.get_headers(), range(min(numRows, self.get_num_rows()))))
         print(self.raw_data[:numRows])
 
+    # writes the data to a CSV file with the headers and types on its first two lines, so that read can load it again;
+    # headers selects the columns to write (all of them by default). Rows are formatted and written WRITE_BLOCK_ROWS at
+    # a time, so memory use does not grow with the number of rows. The file is gzip compressed if compress is True, or
+    # if compress is None and the file name ends in .gz
+    def write(self, filename, headers=None, compress=None):
+
+        if headers is None:
+            headers = self.raw_headers
+        types = [self.raw_types[self.header2raw[header]] for header in headers]
+        if compress is None:
+            compress = filename.endswith('.gz')
+        n = self.get_num_rows() if len(self.header2matrix) > 0 else len(self.raw_data)
+
+        start = time.time()
+        with (gzip.open(filename, 'wt', encoding='utf-8', newline='') if compress
+              else open(filename, 'w', encoding='utf-8', newline='')) as fp:
+            fp.write(','.join(csv_field(header) for header in headers) + '\n')
+            fp.write(','.join(csv_field(type) for type in types) + '\n')
+            for first in range(0, n, WRITE_BLOCK_ROWS):
+                rows = range(first, min(n, first + WRITE_BLOCK_ROWS))
+                columns = [self.format_column(header, rows) for header in headers]
+                fp.write('\n'.join(map(','.join, zip(*columns))) + '\n')
+        self.close()
+        print("Wrote %i rows to %s in %.3f s." % (n, filename, time.time() - start))
+
+    # returns the values of a column in a range of rows as a list of CSV fields; missing values are blank
+    def format_column(self, colHeader, rows):
+
+        if colHeader in self.header2matrix:
+            values = np.asarray(self.get_data([colHeader], rows)).reshape(-1)
+            if np.issubdtype(values.dtype, np.integer):
+                return list(map(str, values.tolist()))
+            if self.raw_types[self.header2raw[colHeader]] == 'int':
+                # an int column that is stored as floats because it has missing values
+                return ['' if x != x else str(int(x)) for x in values.tolist()]
+            # repr gives the shortest string that reads back as the same float64; float32 needs only 9 digits
+            formatter = repr if values.dtype == np.float64 else '{:.9g}'.format
+            return ['' if x != x else formatter(x) for x in values.tolist()]
+        if colHeader in self.categories:
+            table = np.array([csv_field(value) for value in self.categories[colHeader]] + [''], dtype=object)
+            return table[np.asarray(self.get_codes(colHeader)).reshape(-1)[rows.start:rows.stop]].tolist()
+        if colHeader in self.dates:
+            dates = self.get_dates(colHeader)[rows.start:rows.stop]
+            valid = ~np.isnat(dates)
+            # dates without a time of day are written as just the day
+            unit = 'D' if np.all(dates[valid].astype('int64') % 86400 == 0) else 's'
+            strings = np.datetime_as_string(dates, unit=unit).astype(object)
+            strings[~valid] = ''
+            return strings.tolist()
+        col = self.header2raw[colHeader]
+        fields = []
+        for i in rows:
+            row = self.raw_data[i]
+            fields.append(csv_field(str(row[col])) if col < len(row) else '')
+        return fields
+
+    # saves the numeric data, headers, types, category codes, and dates to a binary file that load opens again without
+    # parsing; raw strings of other columns are not saved
+    def save(self, path):
+
+        meta, arrays = self.binary_contents()
+        write_binary(path, meta, arrays)
+        print("Saved %i rows to %s." % (self.get_num_rows(), path))
+
+    # returns the metadata and arrays that save writes
+    def binary_contents(self):
+
+        n = self.get_num_rows()
+        meta = {'kind': 'data', 'filename': self.filename, 'headers': self.raw_headers, 'types': self.raw_types,
+                'numeric': self.get_headers(), 'blocks': self.header2block, 'float32': self.float32,
+                'categories': self.categories}
+        arrays = {}
+        for name in ('float', 'int'):
+            headers = [header for col, header in
+                       sorted((col, header) for header, (block, col) in self.header2block.items() if block == name)]
+            if len(headers) > 0:
+                arrays[name] = np.asarray(self.get_data(headers))
+            else:
+                arrays[name] = np.zeros((n, 0), dtype=self.block(name).dtype)
+        for header in self.categories:
+            arrays['codes:' + header] = np.asarray(self.get_codes(header)).reshape(-1)
+        for header in self.dates:
+            arrays['dates:' + header] = self.get_dates(header)
+        return meta, arrays
+
+    # opens a file written by save and returns it as a Data object, or as a PCAData object if one was saved; with mmap
+    # the numeric data is memory-mapped rather than read, so even a large file opens at once and pages are read from
+    # disk as they are used (changes are made to a private copy and never written back to the file)
+    @staticmethod
+    def load(path, mmap=True):
+
+        meta, arrays = read_binary(path, mmap)
+        if meta['kind'] == 'pca':
+            return PCAData(np.asmatrix(arrays['float']), np.asmatrix(arrays['evecs']), np.asmatrix(arrays['evals']),
+                           np.asmatrix(arrays['means']), meta['data_headers'])
+
+        data = Data(float32=meta['float32'])
+        data.filename = meta['filename']
+        data.set_schema(meta['headers'], meta['types'])
+        data.header2matrix = HeaderIndex(meta['numeric'])
+        for header, (name, col) in meta['blocks'].items():
+            data.header2block[header] = (name, col)
+        data.matrix_data = np.asmatrix(arrays['float'])
+        data.int_data = arrays['int']
+        data.categories = meta['categories']
+        for header in data.categories:
+            data.codes[header] = arrays['codes:' + header]
+        for header in data.dates:
+            data.dates[header] = arrays['dates:' + header]
+        data.raw_data = LazyRows(np.full(data.get_num_rows(), -1), None, data.format_raw_row)
+        return data
+
     # writes out a selected set of headers to a specified file
     def writeHeaders(self, filename, headers=None):
 
@@ -328,6 +1848,446 @@ class Data:
             print("No headers given")
 
 
+""" Queues changes to a Data object so they can be applied together with a single rebuild of its data"""
+class DataBatch:
+
+    # Constructor
+    def __init__(self, data):
+
+        self.data = data
+        self.deleteRows = []
+        self.deleteColumns = []
+        self.addColumns = []
+        self.setValues = []
+
+    # queues adding a column of data
+    def add_column(self, data, colHeader, type):
+
+        self.addColumns.append((data, colHeader, type))
+
+    # queues deleting a column
+    def delete_column(self, colHeader):
+
+        self.deleteColumns.append(colHeader)
+
+    # queues deleting a row (the index of the row before any of the queued changes)
+    def delete_row(self, row):
+
+        self.deleteRows.append(row)
+
+    # queues setting an individual value (the index of the row before any of the queued changes)
+    def set_value(self, value, row, colHeader):
+
+        self.setValues.append((value, row, colHeader))
+
+    # applies all of the queued changes and empties the queue
+    def apply(self):
+
+        self.data.apply_changes(self.deleteRows, self.deleteColumns, self.addColumns, self.setValues)
+        self.__init__(self.data)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+
+        if excType is None:
+            self.apply()
+
+
+""" A subset of the rows of a Data object that reads the parent's storage through an array of row indices"""
+# The subset is read through the parent until either of them changes: the first change made to the subset or to the
+# parent copies the subset's rows out of the parent (as they were before the change), after which the subset is an
+# ordinary Data object.
+class DataSubset(Data):
+
+    # Constructor
+    def __init__(self, parent, rows):
+
+        Data.__init__(self, cache=False, float32=parent.float32)
+        # a subset of a subset reads straight from the original storage
+        if isinstance(parent, DataSubset) and parent.parent is not None:
+            rows = parent.rows[rows]
+            parent = parent.parent
+        self.parent = parent
+        self.rows = np.asarray(rows, dtype='int64')
+        parent.subsets.add(self)
+        self.filename = parent.filename
+        self.raw_headers = parent.raw_headers
+        self.raw_types = parent.raw_types
+        self.header2raw = parent.header2raw
+        self.header2matrix = parent.header2matrix
+        self.header2block = parent.header2block
+        self.categories = parent.categories
+        self.dates = dict.fromkeys(parent.dates)
+        self.raw_data = LazyRows(self.rows, self.parent_raw_row, self.format_raw_row)
+
+    # returns a copy of a raw row of the parent
+    def parent_raw_row(self, row):
+
+        return list(self.parent.get_raw_row(row))
+
+    # returns the number of rows in the numeric data set
+    def get_num_rows(self):
+
+        if self.parent is None:
+            return Data.get_num_rows(self)
+        return len(self.rows)
+
+    # returns a column of data given a column header (string) in the numeric data
+    def get_column(self, colHeader):
+
+        if self.parent is None:
+            return Data.get_column(self, colHeader)
+        if type(colHeader) == int:
+            colHeader = self.get_headers()[colHeader]
+        return self.get_data([colHeader])
+
+    # returns the numeric data (a float) at a row index (int) and column header (string)
+    def get_value(self, row, colHeader):
+
+        if self.parent is None:
+            return Data.get_value(self, row, colHeader)
+        return self.parent.get_value(self.rows[row], colHeader)
+
+    # returns the codes of a string or enum column as an N x 1 matrix
+    def get_codes(self, colHeader):
+
+        if self.parent is None:
+            return Data.get_codes(self, colHeader)
+        return self.parent.get_codes(colHeader)[self.rows]
+
+    # returns the dates of a date column
+    def get_dates(self, colHeader):
+
+        if self.parent is None:
+            return Data.get_dates(self, colHeader)
+        return self.parent.get_dates(colHeader)[self.rows]
+
+    # returns a matrix with the numeric data for the given columns, gathered from the parent in one take
+    def get_data(self, colHeaders, rows=None, dtype=None):
+
+        if self.parent is None:
+            return Data.get_data(self, colHeaders, rows, dtype)
+        rows = self.rows if rows is None else self.rows[np.asarray(rows, dtype='int64').reshape(-1)]
+        return self.parent.get_data(colHeaders, rows, dtype)
+
+    # returns the version of the data, which also changes when the parent does
+    def get_version(self):
+
+        if self.parent is None:
+            return self.version
+        return (self.version, self.parent.get_version())
+
+    # copies the subset's rows out of the parent before the subset is changed
+    def changed(self):
+
+        if self.parent is not None:
+            parent = self.parent
+            # the raw rows are read from the parent, so take them out while it is still attached; rows that are still in
+            # the parent's file are not read
+            if isinstance(parent.raw_data, LazyRows):
+                rawRows = parent.raw_data.take(self.rows, self.format_raw_row)
+            else:
+                rawRows = [list(parent.raw_data[row]) for row in self.rows]
+            self.parent = None
+            parent.subsets.discard(self)
+            self.raw_data = rawRows
+            self.set_numeric(np.asarray(parent.matrix_data)[self.rows], parent.int_data[self.rows])
+            self.raw_headers = list(parent.raw_headers)
+            self.raw_types = list(parent.raw_types)
+            self.header2raw = dict(parent.header2raw)
+            self.header2matrix = HeaderIndex(parent.get_headers())
+            self.header2block = dict(parent.header2block)
+            self.codes = {}
+            for header in parent.categories:
+                self.codes[header] = np.asarray(parent.get_codes(header)).reshape(-1)[self.rows]
+            self.categories = {}
+            for header in parent.categories:
+                self.categories[header] = list(parent.categories[header])
+            for header in parent.dates:
+                self.dates[header] = parent.get_dates(header)[self.rows]
+            self.indexes = {}
+        Data.changed(self)
+
+
+""" Sorts the values of a column once so that the rows with values in a range can be found by binary search"""
+class SortedIndex:
+
+    # Constructor
+    # values is a 1-D array with one value per row; missing values (NaN or NaT) sort to the end and are never in a range
+    def __init__(self, values):
+
+        values = np.asarray(values).reshape(-1)
+        if len(values) < 2 or np.all(values[1:] >= values[:-1]):
+            # data that is already in order, such as a time series, does not need to be sorted
+            self.order = np.arange(len(values))
+        else:
+            self.order = np.argsort(values, kind='stable')
+        self.values = values[self.order]
+        self.tail = []  # values of appended rows, in row order, that have not been merged into the sorted values yet
+        self.tailLength = 0
+
+    def __len__(self):
+
+        return len(self.values) + self.tailLength
+
+    # adds the values of rows appended after the last row; they are kept unsorted until the next query merges them, so
+    # appending rows one at a time does not copy the index each time
+    def append(self, values):
+
+        values = np.asarray(values).reshape(-1)
+        self.tail.append(values)
+        self.tailLength += len(values)
+
+    # merges the appended values into the sorted values without sorting again
+    def merge(self):
+
+        if self.tailLength == 0:
+            return
+        values = np.concatenate(self.tail)
+        rows = np.arange(len(self.values), len(self.values) + len(values))
+        order = np.argsort(values, kind='stable')
+        positions = np.searchsorted(self.values, values[order], side='right')
+        self.values = np.insert(self.values, positions, values[order])
+        self.order = np.insert(self.order, positions, rows[order])
+        self.tail = []
+        self.tailLength = 0
+
+    # returns the indices (in increasing order) of the rows with values between low and high, inclusive; either can be
+    # None to leave that end open
+    def between(self, low=None, high=None):
+
+        self.merge()
+        first = 0 if low is None else np.searchsorted(self.values, low, side='left')
+        last = self.count_valid() if high is None else np.searchsorted(self.values, high, side='right')
+        return np.sort(self.order[first:max(first, last)])
+
+    # returns the number of values that are not missing
+    def count_valid(self):
+
+        self.merge()
+        if len(self.values) == 0 or not np.isnan(self.values[-1]):
+            return len(self.values)
+        return int(np.searchsorted(np.isnan(self.values), True))
+
+
+""" Keeps the count, mean, sum of squared deviations from the mean (M2), minimum, and maximum of a column's values"""
+# Values are added with Welford's update (Chan et al. for several at once) and removed by reversing it, so a change costs
+# O(1) per value. Missing values are skipped.
+class RunningMoments:
+
+    # Constructor
+    def __init__(self, values=()):
+
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.add(values)
+
+    # adds values to the moments
+    def add(self, values):
+
+        values = np.asarray(values, dtype='float64').reshape(-1)
+        values = values[~np.isnan(values)]
+        n = len(values)
+        if n == 0:
+            return
+        valuesMean = np.mean(values)
+        total = self.count + n
+        delta = valuesMean - self.mean
+        self.mean += delta * n / total
+        self.m2 += np.sum(np.square(values - valuesMean)) + delta * delta * self.count * n / total
+        self.count = total
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    # removes a value from the moments; returns False if that cannot be done in O(1) because the value is the minimum or
+    # maximum, in which case the moments have to be rebuilt
+    def remove(self, value):
+
+        value = float(value)
+        if value != value:
+            return True
+        if value <= self.min or value >= self.max:
+            return False
+        self.count -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+        return True
+
+
+""" Summarizes a stream of values in bounded memory so that any quantile can be estimated with a bounded rank error"""
+# A KLL sketch: the values are kept in levels, where each value at level h stands for 2**h of the original values. When a
+# level holds more than its capacity it is sorted and every other value (starting at a random one of the first two) is
+# promoted to the next level, so the sketch holds O(k) values however many are added. Sketches of separate chunks or
+# partitions can be merged into one.
+class QuantileSketch:
+
+    # Constructor
+    # error is the rank error to aim for, as a fraction of the number of values; k (the capacity of the top level) is
+    # derived from it unless it is given
+    def __init__(self, error=SKETCH_ERROR, k=None, seed=None):
+
+        self.k = max(int(np.ceil(2.0 / error)), 8) if k is None else k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.random = np.random.default_rng(seed)
+
+    def __len__(self):
+
+        return self.count
+
+    # adds values to the sketch; missing values are skipped
+    def add(self, values):
+
+        values = np.asarray(values, dtype='float64').reshape(-1)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.compress()
+
+    # adds the values summarized by another sketch to this one
+    def merge(self, other):
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h in range(len(other.levels)):
+            self.levels[h] = np.concatenate((self.levels[h], other.levels[h]))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+
+    # returns the number of values a level can hold; lower levels hold geometrically fewer values than the top one
+    def capacity(self, h):
+
+        return max(int(np.ceil(self.k * (2.0 / 3.0) ** (len(self.levels) - 1 - h))), 2)
+
+    # promotes half of the values of every level that is over its capacity to the next level
+    def compress(self):
+
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                level = np.sort(self.levels[h])
+                odd = len(level) % 2
+                promoted = level[odd + self.random.integers(2)::2]
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1], promoted))
+                self.levels[h] = level[:odd]
+            h += 1
+
+    # returns an array with the estimated value at each quantile in qs (each between 0 and 1); 0 and 1 give the exact
+    # minimum and maximum
+    def quantiles(self, qs):
+
+        qs = np.asarray(qs, dtype='float64').reshape(-1)
+        if self.count == 0:
+            return np.full(len(qs), np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(self.levels[h]), 2 ** h) for h in range(len(self.levels))])
+        order = np.argsort(values, kind='stable')
+        values = values[order]
+        ranks = np.cumsum(weights[order])
+        positions = np.searchsorted(ranks, qs * ranks[-1], side='left')
+        result = values[np.minimum(positions, len(values) - 1)]
+        result[qs <= 0] = self.min
+        result[qs >= 1] = self.max
+        return result
+
+
+""" Splits the rows of a matrix into groups by a key and computes per-group statistics"""
+# The rows are sorted by group once, so every group is a contiguous run and each statistic is a single reduceat over
+# all of the rows instead of a scan per group.
+class GroupBy:
+
+    # Constructor
+    # keys is a list or array with one key per row and values is an N x F matrix
+    def __init__(self, keys, values, headers=None):
+
+        keys = np.asarray(keys).reshape(-1)
+        values = np.asarray(values, dtype='float64')
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        self.headers = headers
+        if np.issubdtype(keys.dtype, np.integer) and len(keys) > 0 and keys.min() >= 0 and keys.max() <= 2 * len(keys):
+            # small non-negative integers such as category codes are counted directly instead of sorted
+            counts = np.bincount(keys)
+            self.keys = np.flatnonzero(counts)
+            self.codes = keys
+            if len(self.keys) < len(counts):
+                renumber = np.zeros(len(counts), dtype=keys.dtype)
+                renumber[self.keys] = np.arange(len(self.keys))
+                self.codes = renumber[keys]
+            self.counts = counts[self.keys]
+        else:
+            self.keys, self.codes = np.unique(keys, return_inverse=True)  # sorted unique keys, group index of each row
+            self.codes = self.codes.reshape(-1)
+            self.counts = np.bincount(self.codes, minlength=len(self.keys))
+        self.order = np.argsort(self.codes, kind='stable')
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+        self.sorted = values[self.order]
+
+    # returns the number of groups
+    def __len__(self):
+
+        return len(self.keys)
+
+    # returns the rows of group i (its index in keys) as a matrix
+    def group(self, i):
+
+        return np.asmatrix(self.sorted[self.starts[i]:self.starts[i] + self.counts[i]])
+
+    # returns a dictionary from each requested statistic (see GROUP_STATS) to a groups x columns matrix (count is a
+    # groups x 1 matrix); var and std are population statistics like np.var and np.std
+    def agg(self, *stats):
+
+        for stat in stats:
+            if stat not in GROUP_STATS:
+                raise ValueError("unknown statistic %s" % stat)
+        result = {}
+        if len(self.keys) == 0:
+            for stat in stats:
+                result[stat] = np.matrix(np.zeros((0, 1 if stat == 'count' else self.sorted.shape[1])))
+            return result
+
+        counts = self.counts.reshape(-1, 1)
+        if 'count' in stats:
+            result['count'] = np.matrix(counts)
+        if set(stats) & {'sum', 'mean', 'var', 'std'}:
+            sums = np.add.reduceat(self.sorted, self.starts, axis=0)
+            means = sums / counts
+            if 'sum' in stats:
+                result['sum'] = np.matrix(sums)
+            if 'mean' in stats:
+                result['mean'] = np.matrix(means)
+            if 'var' in stats or 'std' in stats:
+                # the squared deviations from each row's group mean, summed per group
+                deviations = self.sorted - np.repeat(means, self.counts, axis=0)
+                variances = np.add.reduceat(deviations * deviations, self.starts, axis=0) / counts
+                if 'var' in stats:
+                    result['var'] = np.matrix(variances)
+                if 'std' in stats:
+                    result['std'] = np.matrix(np.sqrt(variances))
+        if 'min' in stats:
+            result['min'] = np.matrix(np.minimum.reduceat(self.sorted, self.starts, axis=0))
+        if 'max' in stats:
+            result['max'] = np.matrix(np.maximum.reduceat(self.sorted, self.starts, axis=0))
+        return result
+
+
 """ Holds information for data in PCA space"""
 class PCAData(Data):
 
@@ -341,10 +2301,23 @@ class PCAData(Data):
         self.means = means  # one row numpy matrix
         self.headers = headers  # list
 
+        self.int_data = np.zeros((self.matrix_data.shape[0], 0), dtype='int8')
+        self.header2matrix = HeaderIndex(headers)
         for i in range(len(headers)):
-            self.header2matrix[headers[i]] = i
-        for i in range(self.matrix_data.shape[0]):
-            self.raw_data.append(self.matrix_data[i, :].tolist()[0])
+            self.header2block[headers[i]] = ('float', i)
+        # the raw rows are only built from the projected data if they are asked for
+        self.raw_data = LazyRows(np.full(self.matrix_data.shape[0], -1), None, self.projected_row)
+
+    # returns a row of the projected data as a list
+    def projected_row(self, row):
+        return self.matrix_data[row, :].tolist()[0]
+
+    # returns the metadata and arrays that save writes: the projected data and the PCA results
+    def binary_contents(self):
+        meta = {'kind': 'pca', 'data_headers': self.headers}
+        arrays = {'float': np.asarray(self.matrix_data), 'evecs': np.asarray(self.evecs),
+                  'evals': np.asarray(self.evals), 'means': np.asarray(self.means)}
+        return meta, arrays
 
     # Accessor for self.matrix_data
     def get_matrix_data(self):
@@ -382,18 +2355,19 @@ if __name__ == "__main__":
 
     data = Data(filename='GOOG-NASDAQ_TSLA.csv')
 
-    # print out some analyses
+    # print out some analyses, computing the descriptive statistics in one pass
+    stats = analysis.describe(['Open', 'Close', 'Volume'], data)
     print("\n\nDescriptive statistics of Tesla's stock data (daily open and close prices and trading volume:")
-    print("Mean: ", analysis.mean(['Open', 'Close', 'Volume'], data))
-    print("Standard deviation: ", analysis.stdev(['Open', 'Close', 'Volume'], data))
-    print("Ranges: ", analysis.dataRange(['Open', 'Close', 'Volume'], data))
+    print("Mean: ", stats['mean'])
+    print("Standard deviation: ", stats['stdev'])
+    print("Ranges: ", np.vstack((stats['min'], stats['max'])).T)
     print("Normalized columns: ", analysis.normalizeColumnsSeparately(['Open', 'Close', 'Volume'], data))
     print("Normalized globally: ", analysis.normalizeColumnsTogether(['Open', 'Close', 'Volume'], data))
-    print("Variance: ", analysis.variance(['Open', 'Close', 'Volume'], data))
-    print("Median: ", analysis.median(['Open', 'Close', 'Volume'], data))
-    print("Mode value: ", analysis.modeValue(['Open', 'Close', 'Volume'], data))
-    print("Mode frequency: ", analysis.modeFreq(['Open', 'Close', 'Volume'], data))
-    print("Range value: ", analysis.rangeDiff(['Open', 'Close', 'Volume'], data), "\n")
+    print("Variance: ", stats['variance'])
+    print("Median: ", stats['median'])
+    print("Mode value: ", stats['mode'])
+    print("Mode frequency: ", stats['modeFreq'])
+    print("Range value: ", stats['range'], "\n")
 
     data.printData(20)
 
@@ -15,6 +15,10 @@ import classifiers
 import numpy as np
 import scipy.stats as st
 import csv
+import concurrent.futures
+
+# how often (in milliseconds) the main loop checks on files that are loading in the background
+LOAD_POLL_MS = 100
 
 # Create a class to build and manage the display
 class DisplayApp:
@@ -45,6 +49,8 @@ class DisplayApp:
         self.filename = None
         self.dataFiles = None
         self.currentData = None
+        self.loadPool = None
+        self.loadFutures = []
         self.PCAData = {}
         self.currentAxes = None
         self.PCAAxes = {}
@@ -155,8 +161,8 @@ class DisplayApp:
         bottomStatusPanel.pack(side=tk.BOTTOM, padx=2, pady=2, fill=tk.Y)
 
         # use a label to set the size of the status panel
-        label = tk.Label(bottomStatusPanel, text="Status Panel")
-        label.pack(side=tk.TOP, pady=10)
+        self.statusLabel = tk.Label(bottomStatusPanel, text="Status Panel")
+        self.statusLabel.pack(side=tk.TOP, pady=10)
 
         # make a separator frame
         sep = tk.Frame(self.root, width=self.initDx, height=2, bd=1, relief=tk.SUNKEN)
@@ -281,11 +287,48 @@ class DisplayApp:
         for i in range(len(files)):
             self.filename.append(files[i])
 
-        # Create a list of Data objects corresponding to the files the user has selected
-        self.dataFiles = []
-        for i in range(len(self.filename)):
-            self.dataFiles.append(data.Data(filename=self.filename[i]))
-        self.currentData = self.dataFiles[0]
+        if len(self.filename) == 0:
+            return
+
+        # Parse all of the selected files in parallel in a pool of processes; the main loop polls for finished files so
+        # the first file can be used as soon as it is ready while the rest keep loading in the background
+        if self.loadPool is None:
+            self.loadPool = concurrent.futures.ProcessPoolExecutor()
+        # Close the source files of the data being replaced
+        for dataFile in self.dataFiles or []:
+            if dataFile:
+                dataFile.close()
+        self.dataFiles = [None] * len(self.filename)
+        self.currentData = None
+        self.loadFutures = [self.loadPool.submit(data.Data, filename) for filename in self.filename]
+        self.statusLabel.config(text="Loading 0 of %i files" % len(self.filename))
+        self.root.after(LOAD_POLL_MS, self.checkLoading, self.loadFutures)
+
+    # collects any files that have finished loading and reports the progress in the status panel
+    def checkLoading(self, futures):
+
+        # Stop if a newer set of files has been opened since this one
+        if futures is not self.loadFutures:
+            return
+
+        for i in range(len(futures)):
+            if self.dataFiles[i] is None and futures[i].done():
+                try:
+                    self.dataFiles[i] = futures[i].result()
+                except Exception as e:
+                    print("Error: unable to open %s (%s)." % (self.filename[i], e))
+                    self.dataFiles[i] = False
+                if i == 0 and self.dataFiles[0] is not False:
+                    self.currentData = self.dataFiles[0]
+                    print("%s is ready." % self.filename[0])
+
+        loaded = len([x for x in self.dataFiles if x is not None])
+        self.statusLabel.config(text="Loaded %i of %i files" % (loaded, len(futures)))
+        if loaded < len(futures):
+            self.root.after(LOAD_POLL_MS, self.checkLoading, futures)
+        else:
+            # Drop the files that failed to load
+            self.dataFiles = [x for x in self.dataFiles if x is not False]
 
     # builds the axes
     def buildAxes(self):
@@ -515,20 +558,7 @@ class DisplayApp:
         if len(self.objects) == 0:
             return
 
-        # Normalize data points
-        if len(self.currentAxes) == 2:
-            mins = np.min(self.points[:, :-2], axis=0)
-            maxes = np.max(self.points[:, :-2], axis=0)
-            self.points = np.divide((self.points[:, :-2] - mins), (maxes - mins))
-            self.points = np.hstack((self.points,
-                                     np.zeros((self.points.shape[0], 1)),
-                                     np.ones((self.points.shape[0], 1))))
-        else:
-            mins = np.min(self.points[:, :-1], axis=0)
-            maxes = np.max(self.points[:, :-1], axis=0)
-            self.points = np.divide((self.points[:, :-1] - mins), (maxes - mins))
-            self.points = np.hstack((self.points, np.ones((self.points.shape[0], 1))))
-
+        # self.points was normalized when it was built, so only the view changes here
         # Make a local copy of the VTM
         vtm = self.view.build()
         self.viewPoints = (vtm * self.points.T).T
@@ -727,19 +757,16 @@ class DisplayApp:
         trainData = data.Data(train)
         testData = data.Data(test)
 
-        # Make the data and labels
+        # Make the data and labels, joining separate label files on as the last column
         if trainLabels != None and testLabels != None:
-            trainLabelsData = data.Data(trainLabels)
-            testLabelsData = data.Data(testLabels)
-            trainLabels1 = trainLabelsData.get_data([trainLabelsData.get_headers()[0]])
-            testLabels1 = testLabelsData.get_data([testLabelsData.get_headers()[0]])
-            A = trainData.get_data(trainData.get_headers())
-            B = testData.get_data(testData.get_headers())
-        else:
-            trainLabels1 = trainData.get_data([trainData.get_headers()[-1]])
-            testLabels1 = testData.get_data([testData.get_headers()[-1]])
-            A = trainData.get_data(trainData.get_headers()[:-1])
-            B = testData.get_data(testData.get_headers()[:-1])
+            trainData = trainData.join(data.Data(trainLabels))
+            testData = testData.join(data.Data(testLabels))
+            if trainData is None or testData is None:
+                return
+        trainLabels1 = trainData.get_data([trainData.get_headers()[-1]])
+        testLabels1 = testData.get_data([testData.get_headers()[-1]])
+        A = trainData.get_data(trainData.get_headers()[:-1])
+        B = testData.get_data(testData.get_headers()[:-1])
 
         # Initialize and build classifiers for NBC and KNN
         nbc = classifiers.NaiveBayes()
@@ -759,16 +786,11 @@ class DisplayApp:
         print(knn.confusion_matrix_str(knn.confusion_matrix(knnTrainLabels, knnTrainCats)))
         print(knn.confusion_matrix_str(knn.confusion_matrix(knnTestLabels, knnTestCats)))
 
-        # Make sure the test labels are in the output Data object
-        if trainLabels != None and testLabels != None:
-            outputData = testData.add_column(testLabels1, 'Labels', 'numeric')
-        else:
-            outputData = testData
+        # The test labels are already in the output Data object
+        outputData = testData
 
         # Write data to a CSV file
-        outputMatrix = outputData.get_data(outputData.get_headers())
-        outputMatrix = np.vstack((np.matrix(outputData.get_headers()), np.matrix(outputData.get_raw_types()), outputMatrix))
-        np.savetxt(filename, outputMatrix, delimiter=",", fmt="%s")
+        outputData.write(filename, outputData.get_headers())
 
     def handleLinearRegression(self):
 
@@ -936,6 +958,8 @@ class DisplayApp:
     def handleQuit(self, event=None):
 
         print('Terminating')
+        if self.loadPool is not None:
+            self.loadPool.shutdown(wait=False, cancel_futures=True)
         self.root.destroy()
 
     def clearData(self, event=None):
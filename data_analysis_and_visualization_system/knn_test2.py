@@ -27,18 +27,17 @@ def main(argv):
 
     # get the categories and the training data A and the test data B
     if len(argv) > 4:
-        traincatdata = data.Data(argv[3])
-        testcatdata = data.Data(argv[4])
-        traincats = traincatdata.get_data( [traincatdata.get_headers()[0]] )
-        testcats = testcatdata.get_data( [testcatdata.get_headers()[0]] )
-        A = dtrain.get_data( dtrain.get_headers() )
-        B = dtest.get_data( dtest.get_headers() )
-    else:
-        # assume the categories are the last column
-        traincats = dtrain.get_data( [dtrain.get_headers()[-1]] )
-        testcats = dtest.get_data( [dtest.get_headers()[-1]] )
-        A = dtrain.get_data( dtrain.get_headers()[:-1] )
-        B = dtest.get_data( dtest.get_headers()[:-1] )
+        # join the category files on so the categories are the last column
+        dtrain = dtrain.join( data.Data(argv[3]) )
+        dtest = dtest.join( data.Data(argv[4]) )
+        if dtrain is None or dtest is None:
+            exit(-1)
+
+    # the categories are the last column
+    traincats = dtrain.get_data( [dtrain.get_headers()[-1]] )
+    testcats = dtest.get_data( [dtest.get_headers()[-1]] )
+    A = dtrain.get_data( dtrain.get_headers()[:-1] )
+    B = dtest.get_data( dtest.get_headers()[:-1] )
 
     # create two classifiers, one using 10 exemplars per class
     knncall = classifiers.KNN()